@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from survey_analysis import (
+    CARE_ORDER,
+    CATEGORY_SCHEMA,
+    DEMOGRAPHICS,
+    IMPORTANCE_ORDER,
+    crosstab,
+    fit_preprocessor,
+    format_survey_data,
+    make_models,
+    poststratify,
+    preprocess_data,
+    transform_demographics,
+)
+
+# Answer options of the FiveThirtyEight comma survey questions
+SURVEY_QUESTIONS = {
+    "In your opinion, which sentence is more gramatically correct?": [
+        "It's important for a person to be honest, kind and loyal.",
+        "It's important for a person to be honest, kind, and loyal.",
+    ],
+    "Prior to reading about it above, had you heard of the serial (or Oxford) comma?": [
+        "No",
+        "Yes",
+    ],
+    "How much, if at all, do you care about the use (or lack thereof) of the serial (or Oxford) comma in grammar?": CARE_ORDER,
+    "How would you write the following sentence?": [
+        "Some experts say it's important to drink milk, but the data are inconclusive.",
+        "Some experts say it's important to drink milk, but the data is inconclusive.",
+    ],
+    'When faced with using the word "data", have you ever spent time considering if the word was a singular or plural noun?': [
+        "No",
+        "Yes",
+    ],
+    'How much, if at all, do you care about the debate over the use of the word "data" as a singluar or plural noun?': CARE_ORDER,
+    "In your opinion, how important or unimportant is proper use of grammar?": IMPORTANCE_ORDER,
+}
+
+RESULTS_PATH = "benchmark_results.json"
+
+
+# The original double loop from plot_bivariate, kept as the reference point
+def loop_crosstab(df, col1, col2, col2_keys):
+    d = {}
+    col1_keys = list(df[col1].dropna().unique())
+    d_sums = [0] * len(col2_keys)
+    for col1_key in col1_keys:
+        d[col1_key] = []
+        for idx, col2_key in enumerate(col2_keys):
+            count = len(df[(df[col1] == col1_key) & (df[col2] == col2_key)])
+            d[col1_key].append(count)
+            d_sums[idx] += count
+    return d, d_sums
+
+
+def random_levels_frame(n_rows, n_levels1, n_levels2, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "a": np.array([f"a{i}" for i in range(n_levels1)], dtype=object)[
+                rng.integers(0, n_levels1, n_rows)
+            ],
+            "b": np.array([f"b{i}" for i in range(n_levels2)], dtype=object)[
+                rng.integers(0, n_levels2, n_rows)
+            ],
+        }
+    )
+
+
+# The 9 census regions, or n synthetic geographies for finer-grained runs
+def synthetic_geographies(n=9):
+    if n == 9:
+        return CATEGORY_SCHEMA["Location (Census Region)"][0]
+    return [f"Geography {i:05d}" for i in range(n)]
+
+
+def _random_categorical(rng, n_rows, levels, missing=0.0, ordered=False):
+    codes = rng.integers(0, len(levels), n_rows).astype(np.int16)
+    if missing:
+        codes[rng.random(n_rows) < missing] = -1
+    return pd.Categorical.from_codes(codes, categories=levels, ordered=ordered)
+
+
+# Survey frame with the columns and category levels of the assembled survey
+def make_synthetic_survey(n_rows, seed=0, missing=0.02, geographies=None):
+    rng = np.random.default_rng(seed)
+    if geographies is None:
+        geographies = synthetic_geographies()
+
+    df = pd.DataFrame({"RespondentID": np.arange(n_rows, dtype=np.int64)})
+    for question, options in SURVEY_QUESTIONS.items():
+        ordered = CATEGORY_SCHEMA.get(question, (None, False))[1]
+        df[question] = _random_categorical(rng, n_rows, options, missing, ordered)
+    for col in DEMOGRAPHICS:
+        levels, ordered = CATEGORY_SCHEMA[col]
+        if col == "Location (Census Region)":
+            levels = geographies
+        df[col] = _random_categorical(rng, n_rows, levels, missing, ordered)
+    return df
+
+
+# Census frame with one row per (geography, demographic cell), as returned by
+# get_census_data. n_rows is rounded up to whole geographies.
+def make_synthetic_census(n_rows, seed=0, geographies=None):
+    rng = np.random.default_rng(seed)
+    columns = [col for col in DEMOGRAPHICS if col != "Location (Census Region)"]
+    cell_levels = [CATEGORY_SCHEMA[col][0] for col in columns]
+    n_cells = int(np.prod([len(levels) for levels in cell_levels]))
+    if geographies is None:
+        geographies = synthetic_geographies(max(9, -(-n_rows // n_cells)))
+
+    grid = np.indices([len(levels) for levels in cell_levels]).reshape(
+        len(columns), -1
+    )
+    census_df = pd.DataFrame(
+        {
+            col: pd.Categorical.from_codes(
+                np.tile(grid[idx], len(geographies)),
+                categories=CATEGORY_SCHEMA[col][0],
+                ordered=CATEGORY_SCHEMA[col][1],
+            )
+            for idx, col in enumerate(columns)
+        }
+    )
+    census_df["Location (Census Region)"] = pd.Categorical.from_codes(
+        np.repeat(np.arange(len(geographies)), n_cells), categories=geographies
+    )
+    census_df["Count"] = rng.integers(0, 100000, len(census_df))
+    return census_df[DEMOGRAPHICS + ["Count"]]
+
+
+def best_time(func, *args, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+# Scaling of crosstab against the loop with row count and number of levels
+def bench_crosstab(row_counts=(10**3, 10**4, 10**5, 10**6), levels=(5, 20)):
+    print(f"{'rows':>10} {'levels':>7} {'loop (s)':>10} {'crosstab (s)':>13}")
+    for n_levels in levels:
+        for n_rows in row_counts:
+            df = random_levels_frame(n_rows, n_levels, n_levels)
+            col2_keys = sorted(df["b"].unique())
+            assert crosstab(df, "a", "b", col2_keys) == loop_crosstab(
+                df, "a", "b", col2_keys
+            )
+            t_loop = best_time(loop_crosstab, df, "a", "b", col2_keys)
+            t_fast = best_time(crosstab, df, "a", "b", col2_keys)
+            print(f"{n_rows:>10} {n_levels:>7} {t_loop:>10.4f} {t_fast:>13.4f}")
+
+
+# Benchmark cases: name -> function(n_rows) returning (callable, args) to time
+def _case_format_survey_data(n_rows):
+    return format_survey_data, (make_synthetic_survey(n_rows),)
+
+
+def _case_crosstab(n_rows):
+    df = make_synthetic_survey(n_rows)
+    return crosstab, (df, "Education", "Household Income")
+
+
+def _case_preprocess_data(n_rows):
+    return preprocess_data, (make_synthetic_survey(n_rows).dropna(),)
+
+
+def _case_make_models(n_rows):
+    df = make_synthetic_survey(n_rows)
+    return make_models, (df, list(SURVEY_QUESTIONS), fit_preprocessor(df.dropna()))
+
+
+def _case_make_models_collapsed(n_rows):
+    func, args = _case_make_models(n_rows)
+    # n_jobs, model_dir, report, collapse
+    return func, args + (1, None, None, True)
+
+
+# Scoring a census of n_rows rows; a fifth of the geographies have no survey
+# respondents, as with fine-grained geographies
+def _case_poststratify(n_rows):
+    census_df = make_synthetic_census(n_rows)
+    geographies = list(census_df["Location (Census Region)"].cat.categories)
+    surveyed = max(1, len(geographies) * 4 // 5)
+    df = make_synthetic_survey(
+        max(10**4, 2 * len(geographies)), missing=0, geographies=geographies
+    )
+    df["Location (Census Region)"] = pd.Categorical.from_codes(
+        np.arange(len(df)) % surveyed, categories=geographies
+    )
+    preprocessor = fit_preprocessor(df.dropna())
+    with contextlib.redirect_stdout(io.StringIO()):
+        questions, models = make_models(df, list(SURVEY_QUESTIONS), preprocessor)
+    return poststratify, (models, questions, preprocessor, census_df)
+
+
+STAGE_CASES = {
+    "format_survey_data": _case_format_survey_data,
+    "crosstab": _case_crosstab,
+    "preprocess_data": _case_preprocess_data,
+    "make_models": _case_make_models,
+    "make_models_collapsed": _case_make_models_collapsed,
+    "poststratify": _case_poststratify,
+}
+
+
+def _matrix_mb(X):
+    if sp.issparse(X):
+        return (X.data.nbytes + X.indices.nbytes + X.indptr.nbytes) / 2**20
+    return X.memory_usage(index=False).sum() / 2**20
+
+
+# Dense against sparse one-hot design matrices as the number of geographies
+# grows: design matrix size, training and census scoring time
+def bench_sparse(n_rows=10**5, geography_counts=(9, 100, 1000, 5000)):
+    print(
+        f"{'geographies':>11} {'design':>7} {'X (MB)':>9} "
+        f"{'train (s)':>10} {'score (s)':>10}"
+    )
+    questions = list(SURVEY_QUESTIONS)
+    for n_geographies in geography_counts:
+        geographies = synthetic_geographies(n_geographies)
+        df = make_synthetic_survey(n_rows, geographies=geographies)
+        census_df = make_synthetic_census(0, geographies=geographies)
+        for sparse in (False, True):
+            design = "sparse" if sparse else "dense"
+            try:
+                preprocessor = fit_preprocessor(df.dropna(), sparse)
+                X = transform_demographics(preprocessor, df.dropna())
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    _, models = make_models(df, questions, preprocessor)
+                t_train = time.perf_counter() - start
+                t_score = best_time(
+                    poststratify, models, questions, preprocessor, census_df
+                )
+            except MemoryError:
+                print(f"{n_geographies:>11} {design:>7} out of memory")
+                continue
+            print(
+                f"{n_geographies:>11} {design:>7} "
+                f"{_matrix_mb(X):>9.1f} {t_train:>10.3f} {t_score:>10.3f}"
+            )
+
+
+# Time every stage at every size and report cases that got slower than
+# threshold times their baseline timing. results_path keeps the timings of the
+# last run and the baseline, which only takes timings of cases it does not have
+# yet unless update_baseline is set. Returns the number of regressions.
+def run_benchmarks(
+    sizes=(10**5, 10**6),
+    stages=None,
+    results_path=RESULTS_PATH,
+    threshold=1.25,
+    repeat=3,
+    update_baseline=False,
+):
+    baseline = {}
+    if os.path.exists(results_path):
+        with open(results_path) as f:
+            results = json.load(f)
+        baseline = results.get("baseline", results["timings"])
+
+    timings = {}
+    regressions = 0
+    for name in stages or STAGE_CASES:
+        for n_rows in sizes:
+            func, args = STAGE_CASES[name](n_rows)
+            key = f"{name}@{n_rows}"
+            timings[key] = best_time(func, *args, repeat=repeat)
+            line = f"{key:<32} {timings[key]:>10.4f} s"
+            if key in baseline:
+                ratio = timings[key] / baseline[key]
+                line += f" ({ratio:.2f}x baseline)"
+                if ratio > threshold:
+                    line += " REGRESSION"
+                    regressions += 1
+            print(line)
+
+    with open(results_path, "w") as f:
+        json.dump(
+            {
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "pandas": pd.__version__,
+                "numpy": np.__version__,
+                "timings": timings,
+                "baseline": (
+                    {**baseline, **timings}
+                    if update_baseline
+                    else {**timings, **baseline}
+                ),
+            },
+            f,
+            indent=1,
+        )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Survey pipeline benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_crosstab = subparsers.add_parser(
+        "crosstab", help="crosstab against the original loop"
+    )
+    parser_crosstab.add_argument("rows", nargs="*", type=float)
+
+    parser_sparse = subparsers.add_parser(
+        "sparse", help="dense against sparse one-hot design matrices"
+    )
+    parser_sparse.add_argument("--rows", type=float, default=1e5)
+    parser_sparse.add_argument(
+        "--geographies", nargs="+", type=int, default=[9, 100, 1000, 5000]
+    )
+
+    parser_stages = subparsers.add_parser("stages", help="pipeline stages at scale")
+    parser_stages.add_argument("--sizes", nargs="+", type=float, default=[1e5, 1e6])
+    parser_stages.add_argument("--stage", action="append", choices=list(STAGE_CASES))
+    parser_stages.add_argument("--results", default=RESULTS_PATH)
+    parser_stages.add_argument("--threshold", type=float, default=1.25)
+    parser_stages.add_argument("--repeat", type=int, default=3)
+    parser_stages.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="store this run's timings as the baseline",
+    )
+
+    args = parser.parse_args()
+    if args.command == "crosstab":
+        if args.rows:
+            bench_crosstab(row_counts=[int(n) for n in args.rows])
+        else:
+            bench_crosstab()
+    elif args.command == "sparse":
+        bench_sparse(int(args.rows), args.geographies)
+    else:
+        sys.exit(
+            run_benchmarks(
+                [int(n) for n in args.sizes],
+                args.stage,
+                args.results,
+                args.threshold,
+                args.repeat,
+                args.update_baseline,
+            )
+            > 0
+        )
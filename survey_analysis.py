@@ -1,19 +1,132 @@
 # -*- coding: utf-8 -*-
+# Plotting and modelling libraries (matplotlib, seaborn, scikit-learn, SciPy)
+# are imported inside the functions that use them, so that counting and the
+# CLI start quickly and headless workers never load matplotlib
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
-import seaborn as sns
-from sklearn import preprocessing
-from sklearn.linear_model import LogisticRegression
-import urllib.request, json
-
-sns.set_context("notebook", font_scale=1, rc={"lines.linewidth": 2.5})
-
-
-def assemble_original_and_extra_survey():
-    url = "https://raw.githubusercontent.com/fivethirtyeight/data/master/comma-survey/comma-survey.csv"
-    df = pd.read_csv(url)
+import joblib
+import urllib.parse, urllib.request, json
+import http.server
+import argparse, glob, gzip, hashlib, io, multiprocessing, os, socket, time
+import asyncio, contextlib, copy, cProfile, csv, functools, tempfile, tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+SURVEY_URL = "https://raw.githubusercontent.com/fivethirtyeight/data/master/comma-survey/comma-survey.csv"
+CENSUS_URL_TEMPLATE = "https://api.census.gov/data/{year}/acs/acs1/pums?tabulate=weight(PWGTP)&col+SCHL_RC1&col+HINCP_RC1&col+AGEP_RC1&col+SEX&row+ucgid&ucgid={ucgids}&recode+SCHL_RC1=%7B%22b%22:%22SCHL%22,%22d%22:%5B%5B%220%22,%2201%22,%2202%22,%2203%22,%2204%22,%2205%22,%2206%22,%2207%22,%2208%22,%2209%22,%2210%22,%2211%22,%2212%22,%2213%22,%2214%22,%2215%22%5D,%5B%2216%22,%2217%22%5D,%5B%2218%22,%2219%22,%2220%22%5D,%5B%2221%22%5D,%5B%2222%22,%2223%22,%2224%22%5D%5D%7D&recode+HINCP_RC1=%7B%22b%22:%22HINCP%22,%22d%22:%5B%5B%7B%22mn%22:1,%22mx%22:24999%7D,%220%22%5D,%5B%7B%22mn%22:25000,%22mx%22:49999%7D%5D,%5B%7B%22mn%22:50000,%22mx%22:99999%7D%5D,%5B%7B%22mn%22:100000,%22mx%22:149999%7D%5D,%5B%7B%22mn%22:150000,%22mx%22:9999999%7D%5D%5D%7D&recode+AGEP_RC1=%7B%22b%22:%22AGEP%22,%22d%22:%5B%5B%7B%22mn%22:18,%22mx%22:29%7D%5D,%5B%7B%22mn%22:30,%22mx%22:44%7D%5D,%5B%7B%22mn%22:45,%22mx%22:60%7D%5D,%5B%7B%22mn%22:61,%22mx%22:99%7D%5D%5D%7D"
+CENSUS_URL = CENSUS_URL_TEMPLATE.format(
+    year=2021, ucgids=",".join(f"0300000US{region}" for region in range(1, 10))
+)
+
+# Downloads are cached on disk under the SHA-256 of their URL. Set
+# SURVEY_OFFLINE=1 to read only from the cache (e.g. on air-gapped machines).
+CACHE_DIR = os.environ.get("SURVEY_CACHE_DIR", ".cache")
+CACHE_TTL = 7 * 24 * 3600
+OFFLINE = os.environ.get("SURVEY_OFFLINE", "") not in ("", "0")
+
+# Fitted demographic encoder shared by training and census scoring
+PREPROCESSOR_PATH = "preprocessor.joblib"
+
+# Worker processes for model training and chart rendering (-1 for all cores)
+N_JOBS = int(os.environ.get("SURVEY_N_JOBS", "1"))
+
+# Fitted per-question models, keyed by question and training-data fingerprint;
+# the MODEL_KEEP most recent per question are kept
+MODEL_DIR = "models"
+MODEL_KEEP = 3
+
+# Input hash of every rendered chart, so unchanged charts are not re-rendered
+CHART_MANIFEST = ".chart_manifest.json"
+
+# Sparse (CSR) one-hot design matrices, for fine-grained geographies
+SPARSE_FEATURES = os.environ.get("SURVEY_SPARSE_FEATURES", "") not in ("", "0")
+
+# Backend for partitioned aggregations: "serial", "processes" (joblib worker
+# processes) or "dask" (dask.delayed, on the active dask scheduler)
+BACKEND = os.environ.get("SURVEY_BACKEND", "serial")
+
+# Glob of survey partition files (CSV or Feather with the assembled columns);
+# when set, the survey is read from these files instead of the cache: counts
+# and crosstabs are aggregated per file, and the frame the models are trained
+# on is their concatenation
+SURVEY_PARTITIONS = os.environ.get("SURVEY_PARTITIONS")
+
+# Train on (demographic cell, answer) counts instead of one row per respondent
+COLLAPSE_TRAINING = os.environ.get("SURVEY_COLLAPSE_TRAINING", "1") not in ("", "0")
+
+# Assembled survey and census frames as memory-mapped Feather files (unset to
+# rebuild them on every run)
+FRAME_DIR = os.environ.get("SURVEY_FRAME_DIR")
+
+# Bootstrap replicates for interval estimates in Section 5 (0 to skip)
+N_BOOT = int(os.environ.get("SURVEY_BOOTSTRAP", "0"))
+
+# Per-stage timing and memory report of a script run (.json or .csv). Set
+# SURVEY_PROFILE_DIR to also dump a cProfile file per stage, and
+# SURVEY_TRACE_MEMORY=1 to also report peak traced Python memory (tracemalloc
+# slows Python-heavy stages down about 2.5x).
+RUN_REPORT_PATH = os.environ.get("SURVEY_RUN_REPORT", "run_report.json")
+PROFILE_DIR = os.environ.get("SURVEY_PROFILE_DIR")
+TRACE_MEMORY = os.environ.get("SURVEY_TRACE_MEMORY", "") not in ("", "0")
+
+
+def cache_path(url, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, hashlib.sha256(url.encode()).hexdigest() + ".gz")
+
+
+# Path of the gzipped cache entry of url, downloading it first unless the entry
+# is younger than ttl seconds. Works with file:// URLs, so a local fixture
+# directory can stand in for the remote endpoints. A download is passed to
+# validate (if given) before it is cached, so a malformed response raises
+# instead of replacing the entry.
+def cached_file(
+    url,
+    cache_dir=CACHE_DIR,
+    ttl=CACHE_TTL,
+    offline=OFFLINE,
+    timeout=None,
+    validate=None,
+):
+    path = cache_path(url, cache_dir)
+    if os.path.exists(path) and (
+        offline or ttl is None or time.time() - os.path.getmtime(path) < ttl
+    ):
+        return path
+    if offline:
+        raise FileNotFoundError(f"{url} is not in the cache at {cache_dir}")
+
+    with urllib.request.urlopen(
+        url, timeout=timeout or socket.getdefaulttimeout()
+    ) as response:
+        payload = response.read()
+    if validate is not None:
+        validate(payload)
+    os.makedirs(cache_dir, exist_ok=True)
+    # A temporary file of its own, so concurrent downloads of the same URL do
+    # not write over each other before one of them is moved into place
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=cache_dir)
+    try:
+        with os.fdopen(fd, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+    return path
+
+
+# Return the payload at url, from the cache if it is younger than ttl seconds
+def fetch_cached(url, **cache_options):
+    with gzip.open(cached_file(url, **cache_options), "rb") as f:
+        return f.read()
+
+
+def assemble_original_and_extra_survey(url=SURVEY_URL, **cache_options):
+    df = pd.read_csv(io.BytesIO(fetch_cached(url, **cache_options)))
 
     print(df.info())
 
@@ -27,6 +140,62 @@ def assemble_original_and_extra_survey():
     extra_survey = extra_survey.rename(columns=columns)
     df = pd.concat([df, extra_survey])
 
+    return to_categorical(df)
+
+
+# Write df as an uncompressed Feather (Arrow IPC) file, so that it can be
+# memory-mapped. Categoricals, and string columns converted to categoricals,
+# are stored dictionary-encoded.
+def write_frame(df, path):
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    strings = {col: "category" for col in df.columns if df[col].dtype == object}
+    table = pa.Table.from_pandas(
+        df.astype(strings).reset_index(drop=True), preserve_index=False
+    )
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    feather.write_feather(table, tmp_path, compression="uncompressed")
+    os.replace(tmp_path, path)
+
+
+# Open a frame written by write_frame. With memory_map, the file is mapped
+# rather than read, so processes on a node share its pages, and columns
+# without nulls are handed to pandas without copying.
+def read_frame(path, columns=None, memory_map=True):
+    import pyarrow.feather as feather
+
+    table = feather.read_table(path, columns=columns, memory_map=memory_map)
+    return table.to_pandas(split_blocks=True)
+
+
+# Fingerprint of the files a frame is built from (path, size and mtime) and
+# of CATEGORY_SCHEMA
+def frame_fingerprint(sources):
+    digest = hashlib.sha256(repr(CATEGORY_SCHEMA).encode())
+    for source in sources:
+        stat = os.stat(source)
+        digest.update(
+            f"{os.path.abspath(source)}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+        )
+    return digest.hexdigest()[:16]
+
+
+# read_frame of the frame built from the current sources if it exists (path
+# with their fingerprint before the extension), otherwise build() written
+# there. Frames built from earlier versions of the sources are removed.
+def load_or_build_frame(path, build, sources=()):
+    stem, ext = os.path.splitext(path)
+    frame_path = f"{stem}-{frame_fingerprint(sources)}{ext}"
+    if os.path.exists(frame_path):
+        return read_frame(frame_path)
+    df = build()
+    write_frame(df, frame_path)
+    for stale in glob.glob(glob.escape(stem) + "-*" + ext):
+        if stale != frame_path:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(stale)
     return df
 
 
@@ -44,176 +213,311 @@ def replace_every_nth_space(a_list, n):
     return return_list
 
 
-# Investigate survey questions, answer options, and count of answers
-def format_survey_data(df):
-    demographic_groups = {}
-    answers = {}
-    for col in df.columns:
-        if col == "RespondentID":
-            continue
-        values, counts = np.unique(df[col].astype(str, copy=True), return_counts=True)
-        print(col)
-        print()
-        print("Options: ", values)
-        print("Counts: ", counts)
-        print("Pct: ", counts / sum(counts))
-        print()
-        print()
-
-        if col in [
-            "Gender",
-            "Age",
-            "Household Income",
-            "Education",
-            "Location (Census Region)",
-        ]:
-            demographic_groups[col] = [list(values), list(counts)]
-        else:
-            answers[col] = [list(values), list(counts)]
-
-    income_order = [
-        "$0 - $24,999",
-        "$25,000 - $49,999",
-        "$50,000 - $99,999",
-        "$100,000 - $149,999",
-        "$150,000+",
-        "nan",
-    ]
-    age_order = ["18-29", "30-44", "45-60", "> 60", "nan"]
-    education_order = [
-        "Less than high school degree",
-        "High school degree",
-        "Some college or Associate degree",
-        "Bachelor degree",
-        "Graduate degree",
-        "nan",
-    ]
-    demographic_groups["Household Income"] = [
-        income_order,
+DEMOGRAPHICS = [
+    "Gender",
+    "Age",
+    "Household Income",
+    "Education",
+    "Location (Census Region)",
+]
+
+CARE_ORDER = ["Not at all", "Not much", "Some", "A lot"]
+IMPORTANCE_ORDER = [
+    "Very unimportant",
+    "Somewhat unimportant",
+    "Neither important nor unimportant (neutral)",
+    "Somewhat important",
+    "Very important",
+]
+
+# Levels of every categorical column shared by the survey and the census, and
+# whether they are ordinal. Unordered columns keep the alphabetical order.
+CATEGORY_SCHEMA = {
+    "Gender": (["Female", "Male"], False),
+    "Age": (["18-29", "30-44", "45-60", "> 60"], True),
+    "Household Income": (
         [
-            demographic_groups["Household Income"][1][
-                demographic_groups["Household Income"][0].index(income_order[i])
-            ]
-            for i in range(len(income_order))
+            "$0 - $24,999",
+            "$25,000 - $49,999",
+            "$50,000 - $99,999",
+            "$100,000 - $149,999",
+            "$150,000+",
         ],
-    ]
-    demographic_groups["Age"] = [
-        age_order,
+        True,
+    ),
+    "Education": (
         [
-            demographic_groups["Age"][1][
-                demographic_groups["Age"][0].index(age_order[i])
-            ]
-            for i in range(len(age_order))
+            "Less than high school degree",
+            "High school degree",
+            "Some college or Associate degree",
+            "Bachelor degree",
+            "Graduate degree",
         ],
-    ]
-    demographic_groups["Education"] = [
-        education_order,
+        True,
+    ),
+    "Location (Census Region)": (
         [
-            demographic_groups["Education"][1][
-                demographic_groups["Education"][0].index(education_order[i])
-            ]
-            for i in range(len(education_order))
+            "East North Central",
+            "East South Central",
+            "Middle Atlantic",
+            "Mountain",
+            "New England",
+            "Pacific",
+            "South Atlantic",
+            "West North Central",
+            "West South Central",
         ],
-    ]
+        False,
+    ),
+    "How much, if at all, do you care about the use (or lack thereof) of the serial (or Oxford) comma in grammar?": (
+        CARE_ORDER,
+        True,
+    ),
+    'How much, if at all, do you care about the debate over the use of the word "data" as a singluar or plural noun?': (
+        CARE_ORDER,
+        True,
+    ),
+    "In your opinion, how important or unimportant is proper use of grammar?": (
+        IMPORTANCE_ORDER,
+        True,
+    ),
+}
+
+
+# Convert the schema columns of df to pd.Categorical (int8 codes) in place
+def to_categorical(df, schema=CATEGORY_SCHEMA):
+    for col, (levels, ordered) in schema.items():
+        if col not in df.columns:
+            continue
+        categorical = pd.Categorical(df[col], categories=levels, ordered=ordered)
+        unknown = pd.isna(categorical) & df[col].notna().to_numpy()
+        if unknown.any():
+            raise ValueError(
+                f"Unexpected values in {col}: {sorted(set(df[col][unknown]))}"
+            )
+        df[col] = categorical
+    return df
 
-    care_order = ["Not at all", "Not much", "Some", "A lot", "nan"]
-    importance_order = [
-        "Very unimportant",
-        "Somewhat unimportant",
-        "Neither important nor unimportant (neutral)",
-        "Somewhat important",
-        "Very important",
-        "nan",
-    ]
-    col = "How much, if at all, do you care about the use (or lack thereof) of the serial (or Oxford) comma in grammar?"
-    answers[col] = [
-        care_order,
-        [
-            answers[col][1][answers[col][0].index(care_order[i])]
-            for i in range(len(care_order))
-        ],
-    ]
-    col = 'How much, if at all, do you care about the debate over the use of the word "data" as a singluar or plural noun?'
-    answers[col] = [
-        care_order,
-        [
-            answers[col][1][answers[col][0].index(care_order[i])]
-            for i in range(len(care_order))
-        ],
-    ]
-    col = "In your opinion, how important or unimportant is proper use of grammar?"
-    answers[col] = [
-        importance_order,
-        [
-            answers[col][1][answers[col][0].index(importance_order[i])]
-            for i in range(len(importance_order))
-        ],
-    ]
+
+# PNG file name of a chart, e.g. chart_file("pie", "Household Income") is
+# "pie_HouseholdIncome.png"
+def chart_file(prefix, *names):
+    return "_".join([prefix] + [name.replace(" ", "") for name in names]) + ".png"
+
+
+# Survey counts store: column -> {"levels": [str, ...], "counts": int64 array}
+# where counts[0] is the number of missing values and counts[code + 1] that of
+# levels[code]. Levels are only ever appended, so counts of different survey
+# waves or shards can be added up slot by slot.
+def _add_counts(store, col, levels, counts):
+    entry = store.setdefault(col, {"levels": [], "counts": np.zeros(1, np.int64)})
+    slot_of = {level: idx + 1 for idx, level in enumerate(entry["levels"])}
+    for level in levels:
+        if level not in slot_of:
+            entry["levels"].append(level)
+            slot_of[level] = len(entry["levels"])
+    if len(entry["counts"]) < len(entry["levels"]) + 1:
+        entry["counts"] = np.concatenate(
+            [
+                entry["counts"],
+                np.zeros(len(entry["levels"]) + 1 - len(entry["counts"]), np.int64),
+            ]
+        )
+    slots = np.array([0] + [slot_of[level] for level in levels], dtype=np.int64)
+    np.add.at(entry["counts"], slots, np.asarray(counts, dtype=np.int64))
+
+
+# Add the value counts of every column of df (one np.bincount over categorical
+# codes per column) to store, in place, and return store
+def update_counts(store, df):
+    for col in df.columns:
+        if col == "RespondentID":
+            continue
+        values = df[col]
+        if not isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.astype("category")
+        codes = values.cat.codes.to_numpy().astype(np.int64)
+        counts = np.bincount(codes + 1, minlength=len(values.cat.categories) + 1)
+        _add_counts(store, col, [str(c) for c in values.cat.categories], counts)
+    return store
+
+
+# Combine counts stores, e.g. of survey waves or of shards counted in parallel
+def merge_counts(*stores):
+    merged = {}
+    for store in stores:
+        for col, entry in store.items():
+            _add_counts(merged, col, entry["levels"], entry["counts"])
+    return merged
+
+
+def save_counts(store, path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(
+            {
+                col: {"levels": entry["levels"], "counts": entry["counts"].tolist()}
+                for col, entry in store.items()
+            },
+            f,
+        )
+    os.replace(tmp_path, path)
+
+
+def load_counts(path):
+    with open(path) as f:
+        return {
+            col: {
+                "levels": entry["levels"],
+                "counts": np.array(entry["counts"], dtype=np.int64),
+            }
+            for col, entry in json.load(f).items()
+        }
+
+
+# Count the survey chunks into the store at path (created if missing), so that
+# a new wave only costs a pass over its own rows
+def update_counts_file(path, chunks):
+    store = load_counts(path) if os.path.exists(path) else {}
+    for chunk in chunks:
+        update_counts(store, chunk)
+    save_counts(store, path)
+    return store
+
+
+# Per-column [values, counts] of the values present, sorted by value (missing
+# values as "nan")
+def counts_by_value(store):
+    col_counts = {}
+    for col, entry in store.items():
+        values = np.array(["nan"] + entry["levels"])
+        present = entry["counts"] > 0
+        values, counts = values[present], entry["counts"][present]
+        order = np.argsort(values, kind="stable")
+        col_counts[col] = [list(values[order]), list(counts[order])]
+    return col_counts
+
+
+# demographic_groups and answers, as returned by format_survey_data, from a
+# counts store
+def format_survey_counts(store, verbose=True):
+    col_counts = counts_by_value(store)
+    if verbose:
+        for col, (values, counts) in col_counts.items():
+            counts = np.array(counts)
+            print(col)
+            print()
+            print("Options: ", np.array(values))
+            print("Counts: ", counts)
+            print("Pct: ", counts / sum(counts))
+            print()
+            print()
+    return group_survey_counts(col_counts)
+
+
+# Investigate survey questions, answer options, and count of answers
+def format_survey_data(df):
+    return format_survey_counts(update_counts({}, df))
+
+
+# Read survey CSVs chunk by chunk. Files in the Google Form export format (with
+# a Timestamp column) are renamed to columns without its leading RespondentID,
+# as in assemble_original_and_extra_survey. columns defaults to those of the
+# first file in the survey format.
+def iter_survey_chunks(sources, chunksize=100000, columns=None):
+    for source in sources:
+        for chunk in pd.read_csv(source, chunksize=chunksize):
+            if "Timestamp" in chunk.columns:
+                if columns is None:
+                    raise ValueError(
+                        f"{source} is a Google Form export; pass the survey columns "
+                        "or list a file in the survey format first"
+                    )
+                chunk = chunk.drop(["Timestamp"], axis=1)
+                chunk.columns = columns[1:]
+            elif columns is None:
+                columns = list(chunk.columns)
+            yield chunk
+
+
+# The original survey (from the cache) and the extra responses, as sources for
+# iter_survey_chunks
+def survey_sources(url=SURVEY_URL, **cache_options):
+    return [cached_file(url, **cache_options), "new_comma_survey.csv"]
+
+
+# Same counts as format_survey_data, updated chunk by chunk so that memory stays
+# flat
+def format_survey_data_streaming(chunks):
+    store = {}
+    for chunk in chunks:
+        update_counts(store, chunk)
+    return format_survey_counts(store, verbose=False)
+
+
+# Split per-column [values, counts] into demographics and answers, and put the
+# ordinal columns in their natural order (levels nobody chose count 0)
+def group_survey_counts(col_counts):
+    demographic_groups = {}
+    answers = {}
+    for col, value_counts in col_counts.items():
+        if col in DEMOGRAPHICS:
+            demographic_groups[col] = value_counts
+        else:
+            answers[col] = value_counts
+
+    for col, (levels, ordered) in CATEGORY_SCHEMA.items():
+        groups = demographic_groups if col in DEMOGRAPHICS else answers
+        if not ordered or col not in groups:
+            continue
+        order = levels + ["nan"]
+        value_to_count = dict(zip(*groups[col]))
+        groups[col] = [order, [value_to_count.get(value, 0) for value in order]]
 
     return demographic_groups, answers
 
 
-def plot_distributions(plot_dict):
-    for col, options in plot_dict.items():
-        if (
-            col
-            == "In your opinion, how important or unimportant is proper use of grammar?"
-        ):
-            adj_options = replace_every_nth_space(options[0], 2)
-            plt.figure(figsize=(6, 4))
-            plt.bar(adj_options, options[1])
-            plt.title(col)
-            plt.ylabel("Number of responses")
+def plot_distribution(col, options):
+    import matplotlib.pyplot as plt
 
-            print()
-            plt.figure(figsize=(14, 10))
-            # plt.pie(options[1], labels=adj_options,autopct='%1.1f%%')
-            plt.pie(
-                [options[1][i] for i in [0, 3, 1, 4, 2, 5]],
-                labels=[adj_options[i] for i in [0, 3, 1, 4, 2, 5]],
-                autopct="%1.1f%%",
-            )
-            plt.title(col)
+    adj_options = replace_every_nth_space(options[0], 2)
+    plt.figure(figsize=(14, 10))
+    plt.pie(options[1], labels=adj_options, autopct="%1.1f%%")
+    plt.title(col)
 
-            plt.savefig(f"distribution_{col.replace(' ', '')}")
-            plt.close()
-            print()
+    plt.savefig(chart_file("distribution", col))
+    plt.close()
 
 
 def plot_distributions(plot_dict):
     for col, options in plot_dict.items():
-        adj_options = replace_every_nth_space(options[0], 2)
-        plt.figure(figsize=(6, 4))
-        plt.bar(adj_options, options[1])
-        plt.title(col)
-        plt.ylabel("Number of responses")
+        plot_distribution(col, options)
 
-        print()
-        plt.figure(figsize=(14, 10))
-        plt.pie(options[1], labels=adj_options, autopct="%1.1f%%")
-        plt.title(col)
-
-        plt.savefig(f"distribution_{col.replace(' ', '')}")
-        plt.close()
-        print()
 
-
-def plot_bivariate(df, col1, col2, col2_keys=None):
-    d = {}
+# Count table of col1 levels (rows) against col2 levels (columns) in one pass
+# over integer codes, plus the per-column totals
+def crosstab(df, col1, col2, col2_keys=None):
     col1_keys = list(df[col1].dropna().unique())
     if col2_keys is None:
         col2_keys = sorted(list(df[col2].dropna().unique()))
+    if len(col2_keys) == 0:
+        return {}, []
+
+    codes1 = pd.Categorical(df[col1], categories=col1_keys).codes.astype(np.int64)
+    codes2 = pd.Categorical(df[col2], categories=col2_keys).codes.astype(np.int64)
+    present = (codes1 >= 0) & (codes2 >= 0)
+    table = np.bincount(
+        codes1[present] * len(col2_keys) + codes2[present],
+        minlength=len(col1_keys) * len(col2_keys),
+    ).reshape(len(col1_keys), len(col2_keys))
 
-    d_sums = [0] * len(col2_keys)
+    d = {col1_key: table[idx].tolist() for idx, col1_key in enumerate(col1_keys)}
+    d_sums = table.sum(axis=0).tolist()
+    return d, d_sums
 
-    for col1_key in col1_keys:
-        d[col1_key] = []
-        for idx, col2_key in enumerate(col2_keys):
-            count = len(df[(df[col1] == col1_key) & (df[col2] == col2_key)])
-            d[col1_key].append(count)
-            d_sums[idx] += count
-        if d[col1_key] == []:
-            del d[col1_key]
+
+def plot_bivariate_counts(d, d_sums, col1, col2, col2_keys):
+    import matplotlib.pyplot as plt
 
     ind = np.arange(len(col2_keys))
     width = 0.35
@@ -226,21 +530,20 @@ def plot_bivariate(df, col1, col2, col2_keys=None):
         bottoms = [bottoms[idx] + val for idx, val in enumerate(counts)]
     ax.legend()
     plt.xticks(ticks=ind, labels=list(col2_keys))
-    plt.savefig(f"bivariate_{col1.replace(' ', '')}_{col2.replace(' ', '')}")
+    plt.savefig(chart_file("bivariate", col1, col2))
     plt.close()
-    return d
 
 
-def analyze_assembled_survey(df, demographic_groups, answers):
-    sns.set_context("notebook", font_scale=1.5, rc={"lines.linewidth": 2.5})
-    plot_distributions(demographic_groups)
-
-    plot_distributions(answers)
+def plot_bivariate(df, col1, col2, col2_keys=None):
+    if col2_keys is None:
+        col2_keys = sorted(list(df[col2].dropna().unique()))
+    d, d_sums = crosstab(df, col1, col2, col2_keys)
+    plot_bivariate_counts(d, d_sums, col1, col2, col2_keys)
+    return d
 
-    sns.set_context("notebook", font_scale=0.8, rc={"lines.linewidth": 2.5})
 
-    plot_bivariate(
-        df,
+BIVARIATE_CHARTS = [
+    (
         "Education",
         "Household Income",
         [
@@ -250,17 +553,13 @@ def analyze_assembled_survey(df, demographic_groups, answers):
             "$100,000 - $149,999",
             "$150,000+",
         ],
-    )
-
-    plot_bivariate(
-        df,
+    ),
+    (
         "In your opinion, how important or unimportant is proper use of grammar?",
         "How much, if at all, do you care about the use (or lack thereof) of the serial (or Oxford) comma in grammar?",
         ["Not at all", "Not much", "Some", "A lot"],
-    )
-
-    plot_bivariate(
-        df,
+    ),
+    (
         "In your opinion, how important or unimportant is proper use of grammar?",
         "Education",
         [
@@ -270,201 +569,980 @@ def analyze_assembled_survey(df, demographic_groups, answers):
             "Some college or Associate degree",
             "Graduate degree",
         ],
-    )
+    ),
+]
+
+
+# A partition is a DataFrame or the path of a CSV or Feather file with the
+# assembled survey (or census) columns. Paths are read by the worker itself, so
+# a partitioned archive never has to fit in one process.
+def _load_partition(partition):
+    if isinstance(partition, pd.DataFrame):
+        return partition
+    if str(partition).endswith(".feather"):
+        return read_frame(partition)
+    return to_categorical(pd.read_csv(partition))
+
+
+def _apply_to_partition(func, partition):
+    return func(_load_partition(partition))
+
+
+# [func(partition) for partition in partitions] on the given backend (see
+# BACKEND), over n_jobs worker processes for "processes"
+def map_partitions(func, partitions, backend=BACKEND, n_jobs=-1):
+    if backend == "serial":
+        return [_apply_to_partition(func, partition) for partition in partitions]
+    if backend == "processes":
+        return joblib.Parallel(n_jobs=n_jobs)(
+            joblib.delayed(_apply_to_partition)(func, partition)
+            for partition in partitions
+        )
+    if backend == "dask":
+        try:
+            import dask
+        except ImportError as e:
+            raise ImportError("The dask backend requires dask to be installed") from e
+        tasks = [
+            dask.delayed(_apply_to_partition)(func, partition)
+            for partition in partitions
+        ]
+        return list(dask.compute(*tasks))
+    raise ValueError(f"Unknown backend: {backend}")
 
 
-def preprocess_data(data, test_data=None):
-    demographics = [
-        "Gender",
-        "Age",
-        "Household Income",
-        "Education",
-        "Location (Census Region)",
-    ]
-    X_demographics = data[demographics]
-    enc_gender = preprocessing.OrdinalEncoder()
-    X_demographics["Gender"] = enc_gender.fit_transform(
-        np.squeeze(X_demographics["Gender"].array).reshape(-1, 1)
+# Partitions of an in-memory frame for the backend: the whole frame when running
+# serially, otherwise one slice per core
+def frame_partitions(df, backend=BACKEND):
+    if backend == "serial":
+        return [df]
+    size = max(1, -(-len(df) // (os.cpu_count() or 1)))
+    return [df.iloc[start : start + size] for start in range(0, len(df), size)]
+
+
+# Survey partitions: the SURVEY_PARTITIONS files if configured, else df split
+# for the backend
+def survey_partitions(df=None, backend=BACKEND):
+    if SURVEY_PARTITIONS:
+        paths = sorted(glob.glob(SURVEY_PARTITIONS))
+        if not paths:
+            raise FileNotFoundError(f"No survey partitions match {SURVEY_PARTITIONS}")
+        return paths
+    return frame_partitions(df, backend)
+
+
+def _partition_counts(df):
+    return update_counts({}, df)
+
+
+# Counts store (see update_counts) of all partitions
+def partitioned_counts(partitions, backend=BACKEND, n_jobs=-1):
+    return merge_counts(
+        *map_partitions(_partition_counts, partitions, backend, n_jobs)
     )
 
-    age_str_to_value = {
-        "30-44": 37.0,
-        "18-29": 23.5,
-        "> 60": 70.0,
-        "45-60": 52.0,
-        np.nan: np.nan,
-    }
-    X_demographics["Age"] = X_demographics["Age"].apply(lambda s: age_str_to_value[s])
-
-    income_str_to_value = {
-        "$50,000 - $99,999": 75000,
-        np.nan: np.nan,
-        "$25,000 - $49,999": 37500,
-        "$0 - $24,999": 12500,
-        "$150,000+": 200000,
-        "$100,000 - $149,999": 125000,
-    }
-    X_demographics["Household Income"] = X_demographics["Household Income"].apply(
-        lambda s: income_str_to_value[s]
+
+def _partition_crosstab(df, col1, col2, col2_keys):
+    if col2_keys is None:
+        col2_keys = sorted(list(df[col2].dropna().unique()))
+    d, _ = crosstab(df, col1, col2, col2_keys)
+    return d, list(col2_keys)
+
+
+# crosstab over all partitions; rows are in order of first appearance across
+# the partitions, as for crosstab on their concatenation
+def partitioned_crosstab(
+    partitions, col1, col2, col2_keys=None, backend=BACKEND, n_jobs=-1
+):
+    func = functools.partial(
+        _partition_crosstab, col1=col1, col2=col2, col2_keys=col2_keys
+    )
+    partials = map_partitions(func, partitions, backend, n_jobs)
+    if col2_keys is None:
+        col2_keys = sorted(set().union(*(keys for _, keys in partials)))
+    if len(col2_keys) == 0:
+        return {}, []
+
+    position = {key: idx for idx, key in enumerate(col2_keys)}
+    table = {}
+    for d, keys in partials:
+        columns = [position[key] for key in keys]
+        for col1_key, counts in d.items():
+            row = table.setdefault(col1_key, np.zeros(len(col2_keys), np.int64))
+            row[columns] += counts
+
+    d = {col1_key: row.tolist() for col1_key, row in table.items()}
+    d_sums = sum(table.values(), np.zeros(len(col2_keys), np.int64)).tolist()
+    return d, d_sums
+
+
+def _partition_group_sums(df, cols):
+    return df.groupby(cols, observed=True)["Count"].sum().reset_index()
+
+
+# groupby(cols)["Count"].sum() over all partitions, as a frame with the cols and
+# Count, so it can stand in for the full frame in create_pie_plots,
+# plot_pie_in_pie and multi_barplot. Columns keep their categorical order when
+# all partitions share the same categories.
+def partitioned_group_sums(partitions, cols, backend=BACKEND, n_jobs=-1):
+    func = functools.partial(_partition_group_sums, cols=list(cols))
+    partials = map_partitions(func, partitions, backend, n_jobs)
+    return (
+        pd.concat(partials, ignore_index=True)
+        .groupby(list(cols), observed=True)["Count"]
+        .sum()
+        .reset_index()
     )
 
-    # Check the order here (of)
-    enc_edu = preprocessing.OrdinalEncoder()
-    X_demographics["Education"] = enc_edu.fit_transform(
-        np.squeeze(X_demographics["Education"].array).reshape(-1, 1)
+
+# A chart spec is (output file, font_scale, plot function, args). The aggregates
+# are computed up front, over the survey partitions, so that specs are small and
+# can be rendered anywhere.
+def survey_chart_specs(
+    partitions, demographic_groups, answers, backend=BACKEND, n_jobs=-1
+):
+    specs = [
+        (chart_file("distribution", col), 1.5, plot_distribution, (col, options))
+        for plot_dict in (demographic_groups, answers)
+        for col, options in plot_dict.items()
+    ]
+    for col1, col2, col2_keys in BIVARIATE_CHARTS:
+        d, d_sums = partitioned_crosstab(
+            partitions, col1, col2, col2_keys, backend, n_jobs
+        )
+        specs.append(
+            (
+                chart_file("bivariate", col1, col2),
+                0.8,
+                plot_bivariate_counts,
+                (d, d_sums, col1, col2, col2_keys),
+            )
+        )
+    return specs
+
+
+def census_chart_specs(demographic_groups, census_df, backend=BACKEND, n_jobs=-1):
+    partitions = frame_partitions(census_df, backend)
+    income = partitioned_group_sums(
+        partitions, ["Household Income"], backend, n_jobs
     )
+    location = partitioned_group_sums(
+        partitions, ["Location (Census Region)"], backend, n_jobs
+    )
+    return [
+        (
+            chart_file("pie", "Household Income"),
+            0.8,
+            create_pie_plots,
+            (income, "Household Income"),
+        ),
+        (
+            chart_file("pie_in_pie", "Location (Census Region)"),
+            0.8,
+            plot_pie_in_pie,
+            (demographic_groups, location, "Location (Census Region)"),
+        ),
+        (
+            chart_file("multi_barplot", "Household Income"),
+            0.8,
+            multi_barplot,
+            (demographic_groups, income, "Household Income"),
+        ),
+    ]
 
-    enc_loc = preprocessing.OneHotEncoder(sparse=False)
-    locations = enc_loc.fit_transform(
-        np.squeeze(X_demographics["Location (Census Region)"].array).reshape(-1, 1)
+
+def _init_render_worker():
+    import matplotlib.pyplot as plt
+
+    plt.switch_backend("Agg")
+
+
+def render_chart(spec):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    _, font_scale, func, args = spec
+    sns.set_context("notebook", font_scale=font_scale, rc={"lines.linewidth": 2.5})
+    try:
+        func(*args)
+    finally:
+        plt.close("all")
+
+
+def _hash_update(h, obj):
+    if isinstance(obj, pd.DataFrame):
+        _hash_update(h, list(obj.columns))
+        h.update(pd.util.hash_pandas_object(obj).to_numpy().tobytes())
+    elif isinstance(obj, pd.Series):
+        h.update(pd.util.hash_pandas_object(obj).to_numpy().tobytes())
+    elif isinstance(obj, np.ndarray) and obj.dtype != object:
+        h.update(obj.tobytes())
+    elif isinstance(obj, dict):
+        h.update(b"{")
+        for key, value in obj.items():
+            _hash_update(h, key)
+            _hash_update(h, value)
+        h.update(b"}")
+    elif isinstance(obj, (list, tuple, np.ndarray)):
+        h.update(b"[")
+        for value in obj:
+            _hash_update(h, value)
+        h.update(b"]")
+    else:
+        h.update(repr(obj).encode())
+        h.update(b",")
+
+
+# Hash of everything a chart is drawn from: plot function, font scale and the
+# input aggregate
+def chart_hash(spec):
+    _, font_scale, func, args = spec
+    h = hashlib.sha256(f"{func.__name__}:{font_scale}".encode())
+    _hash_update(h, args)
+    return h.hexdigest()
+
+
+# Render chart specs under the Agg backend, over n_jobs worker processes (-1 for
+# all cores). With a manifest_path, charts whose output file exists and was
+# rendered from the same inputs (see chart_hash) are skipped.
+def render_charts(specs, n_jobs=1, manifest_path=None):
+    if manifest_path is not None:
+        manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        hashes = {spec[0]: chart_hash(spec) for spec in specs}
+        specs = [
+            spec
+            for spec in specs
+            if manifest.get(spec[0]) != hashes[spec[0]]
+            or not os.path.exists(spec[0])
+        ]
+        print(f"Rendering {len(specs)} of {len(hashes)} charts")
+
+    if n_jobs == 1:
+        _init_render_worker()
+        for spec in specs:
+            render_chart(spec)
+    else:
+        processes = None if n_jobs == -1 else n_jobs
+        with multiprocessing.Pool(processes, initializer=_init_render_worker) as pool:
+            pool.map(render_chart, specs, chunksize=1)
+
+    if manifest_path is not None:
+        manifest.update(hashes)
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+def analyze_assembled_survey(
+    partitions, demographic_groups, answers, n_jobs=1, manifest_path=None
+):
+    render_charts(
+        survey_chart_specs(
+            partitions, demographic_groups, answers, n_jobs=n_jobs
+        ),
+        n_jobs,
+        manifest_path,
     )
-    X_demographics[enc_loc.get_feature_names(["location"])] = locations
 
-    # Now we should have everything in the right type (float)
-    # To finish, we standardize everything
-    scaler = preprocessing.StandardScaler()
-    X_demographics[["Household Income", "Age", "Education"]] = scaler.fit_transform(
-        X_demographics[["Household Income", "Age", "Education"]].to_numpy()
+
+AGE_VALUES = {"18-29": 23.5, "30-44": 37.0, "45-60": 52.0, "> 60": 70.0}
+INCOME_VALUES = {
+    "$0 - $24,999": 12500,
+    "$25,000 - $49,999": 37500,
+    "$50,000 - $99,999": 75000,
+    "$100,000 - $149,999": 125000,
+    "$150,000+": 200000,
+}
+
+
+# Map string levels to numbers with a NumPy take over categorical codes;
+# missing or unknown levels become NaN
+def encode_numeric(series, mapping):
+    codes = pd.Categorical(series, categories=list(mapping)).codes
+    values = np.append(np.array(list(mapping.values()), dtype=float), np.nan)
+    return values[codes]
+
+
+def _age_to_value(X):
+    return encode_numeric(np.asarray(X)[:, 0], AGE_VALUES).reshape(-1, 1)
+
+
+def _income_to_value(X):
+    return encode_numeric(np.asarray(X)[:, 0], INCOME_VALUES).reshape(-1, 1)
+
+
+# Unfitted encoder for the demographic columns: Gender and Education are
+# ordinal-encoded, Age and Household Income mapped to numbers, the numeric
+# columns standardized and the location one-hot encoded. Geographies without
+# respondents (common for states or PUMAs) are encoded as all zeros, so their
+# census cells are scored without a location effect. With sparse, the output is
+# a CSR matrix, for geographies with thousands of levels.
+def make_preprocessor(sparse=False):
+    from sklearn import preprocessing
+    from sklearn.compose import ColumnTransformer
+    from sklearn.pipeline import make_pipeline
+
+    return ColumnTransformer(
+        [
+            ("Gender", preprocessing.OrdinalEncoder(), ["Gender"]),
+            (
+                "Age",
+                make_pipeline(
+                    preprocessing.FunctionTransformer(_age_to_value),
+                    preprocessing.StandardScaler(),
+                ),
+                ["Age"],
+            ),
+            (
+                "Household Income",
+                make_pipeline(
+                    preprocessing.FunctionTransformer(_income_to_value),
+                    preprocessing.StandardScaler(),
+                ),
+                ["Household Income"],
+            ),
+            (
+                "Education",
+                make_pipeline(
+                    preprocessing.OrdinalEncoder(), preprocessing.StandardScaler()
+                ),
+                ["Education"],
+            ),
+            (
+                "location",
+                preprocessing.OneHotEncoder(sparse=sparse, handle_unknown="ignore"),
+                ["Location (Census Region)"],
+            ),
+        ],
+        sparse_threshold=1.0 if sparse else 0.0,
     )
-    X_demographics = X_demographics.drop(columns=["Location (Census Region)"])
 
-    if test_data is not None:
-        X_test = test_data[demographics]
-        X_test["Gender"] = enc_gender.transform(
-            np.squeeze(X_test["Gender"].array).reshape(-1, 1)
-        )
-        X_test["Age"] = X_test["Age"].apply(lambda s: age_str_to_value[s])
-        X_test["Household Income"] = X_test["Household Income"].apply(
-            lambda s: income_str_to_value[s]
-        )
-        X_test["Education"] = enc_edu.transform(
-            np.squeeze(X_test["Education"].array).reshape(-1, 1)
-        )
-        locations_test = enc_loc.transform(
-            np.squeeze(X_test["Location (Census Region)"].array).reshape(-1, 1)
-        )
-        X_test[enc_loc.get_feature_names(["location"])] = locations_test
 
-        X_test[["Household Income", "Age", "Education"]] = scaler.transform(
-            X_test[["Household Income", "Age", "Education"]].to_numpy()
-        )
-        X_test = X_test.drop(columns=["Location (Census Region)"])
+def fit_preprocessor(data, sparse=False):
+    return make_preprocessor(sparse).fit(data[DEMOGRAPHICS])
+
+
+def feature_names(preprocessor):
+    from sklearn import preprocessing
+
+    names = []
+    for name, transformer, columns in preprocessor.transformers_:
+        if isinstance(transformer, str):
+            continue
+        if isinstance(transformer, preprocessing.OneHotEncoder):
+            names += [f"{name}_{c}" for c in transformer.categories_[0]]
+        else:
+            names += list(columns)
+    return names
+
+
+# Encoded demographics as a DataFrame, or as a CSR matrix (columns in the
+# order of feature_names) for a sparse preprocessor
+def transform_demographics(preprocessor, data):
+    import scipy.sparse as sp
+
+    X = preprocessor.transform(data[DEMOGRAPHICS])
+    if sp.issparse(X):
+        return X.tocsr()
+    return pd.DataFrame(X, columns=feature_names(preprocessor), index=data.index)
+
+
+def _as_matrix(X):
+    import scipy.sparse as sp
+
+    return X if sp.issparse(X) else np.asarray(X)
+
+
+def save_preprocessor(preprocessor, path=PREPROCESSOR_PATH):
+    joblib.dump(preprocessor, path)
+
+
+def load_preprocessor(path=PREPROCESSOR_PATH):
+    return joblib.load(path)
+
+
+# Encode data (and test_data) with preprocessor, fitting it on data first if
+# none is given
+def preprocess_data(data, test_data=None, preprocessor=None):
+    if preprocessor is None:
+        preprocessor = fit_preprocessor(data)
+
+    X_demographics = transform_demographics(preprocessor, data)
+    if test_data is not None:
+        X_test = transform_demographics(preprocessor, test_data)
     else:
         X_test = test_data
 
     return X_demographics, X_test
 
 
-def make_models(df):
-    df_plain = df.dropna()
-    X_demographics, _ = preprocess_data(df_plain)
+# Wide sparse designs use saga, which works on the CSR matrix directly and
+# scales better than lbfgs with many one-hot columns (but converges slowly when
+# there are only a few)
+def make_question_model(X):
+    import scipy.sparse as sp
+    from sklearn.linear_model import LogisticRegression
 
-    questions = answers.keys()
+    if sp.issparse(X) and X.shape[1] > 100:
+        return LogisticRegression(
+            multi_class="multinomial", solver="saga", max_iter=1000, random_state=0
+        )
+    return LogisticRegression(multi_class="multinomial", random_state=0)
 
-    models_for_questions = {}
+
+def _fit_question_model(X, y, sample_weight=None):
+    return make_question_model(X).fit(X, y, sample_weight=sample_weight)
+
+
+def data_fingerprint(X, y, sample_weight=None):
+    import scipy.sparse as sp
+
+    h = hashlib.sha256()
+    if sp.issparse(X):
+        X = X.tocsr()
+        h.update(repr(X.shape).encode())
+        for array in (X.indptr, X.indices, X.data):
+            h.update(np.ascontiguousarray(array).tobytes())
+    else:
+        h.update("\x1f".join(map(str, X.columns)).encode())
+        h.update(pd.util.hash_pandas_object(X, index=False).to_numpy().tobytes())
+    h.update(pd.util.hash_pandas_object(y, index=False).to_numpy().tobytes())
+    if sample_weight is not None:
+        h.update(np.ascontiguousarray(sample_weight, dtype=np.float64).tobytes())
+    return h.hexdigest()[:16]
+
+
+# Models are stored as <model_dir>/<question hash>-<data fingerprint>.joblib.
+# A stored model for the same data is loaded as is; when the data changed, the
+# latest model for the question warm-starts the new fit, and only the keep most
+# recent models of the question are kept.
+def load_or_fit_model(
+    question, X, y, model_dir=MODEL_DIR, sample_weight=None, keep=MODEL_KEEP
+):
+    question_hash = hashlib.sha256(question.encode()).hexdigest()[:16]
+    prefix = os.path.join(model_dir, question_hash)
+    path = f"{prefix}-{data_fingerprint(X, y, sample_weight)}.joblib"
+    if os.path.exists(path):
+        return joblib.load(path)
+
+    m = None
+    previous = sorted(glob.glob(f"{prefix}-*.joblib"), key=os.path.getmtime)
+    if previous:
+        m = joblib.load(previous[-1])
+        same_classes = list(m.classes_) == list(np.unique(np.asarray(y)))
+        if same_classes and m.coef_.shape[1] == X.shape[1]:
+            m.set_params(warm_start=True)
+        else:
+            m = None
+    if m is None:
+        m = make_question_model(X)
+    m.fit(X, y, sample_weight=sample_weight)
+
+    os.makedirs(model_dir, exist_ok=True)
+    joblib.dump(m, path)
+    stored = sorted(glob.glob(f"{prefix}-*.joblib"), key=os.path.getmtime)
+    for old_path in stored[:-keep]:
+        if old_path != path:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(old_path)
+    return m
+
+
+# Training data of each question with respondents collapsed into one row per
+# observed (demographic cell, answer) and its count as sample weight. The
+# weighted log-loss equals the per-respondent one, so the fit is the same while
+# the design matrix has at most cells x answers rows. Yields (X, y, counts).
+def collapse_responses(preprocessor, df_plain, questions):
+    import scipy.sparse as sp
+
+    cell_ids = (
+        df_plain.groupby(DEMOGRAPHICS, observed=True, sort=False).ngroup().to_numpy()
+    )
+    first_rows = np.unique(cell_ids, return_index=True)[1]
+    X_cells = transform_demographics(preprocessor, df_plain.iloc[first_rows])
 
     for question in questions:
-        m = LogisticRegression(multi_class="multinomial")
-        y = df_plain[question]
-        m.fit(X_demographics, y)
+        answers = pd.Categorical(df_plain[question])
+        n_answers = len(answers.categories)
+        keys, counts = np.unique(
+            cell_ids.astype(np.int64) * n_answers + answers.codes, return_counts=True
+        )
+        rows = keys // n_answers
+        X = X_cells[rows] if sp.issparse(X_cells) else X_cells.iloc[rows]
+        y = pd.Series(np.asarray(answers.categories)[keys % n_answers], name=question)
+        yield X, y, counts
+
+
+# One multinomial model per question, fitted over n_jobs worker processes
+# (-1 for all cores). The fits are independent, so the result does not depend
+# on n_jobs. With a model_dir, models are reused from the model store. With
+# collapse, models are fitted on answer counts per demographic cell (see
+# collapse_responses).
+def make_models(
+    df,
+    questions,
+    preprocessor=None,
+    n_jobs=1,
+    model_dir=None,
+    report=None,
+    collapse=False,
+):
+    df_plain = df.dropna()
+    if preprocessor is None:
+        preprocessor = fit_preprocessor(df_plain)
+
+    questions = list(questions)
+    if collapse:
+        training = collapse_responses(preprocessor, df_plain, questions)
+    else:
+        X_demographics = transform_demographics(preprocessor, df_plain)
+        training = ((X_demographics, df_plain[q], None) for q in questions)
+
+    if model_dir is None:
+        jobs = (
+            joblib.delayed(timed)(_fit_question_model, X, y, sample_weight)
+            for X, y, sample_weight in training
+        )
+    else:
+        jobs = (
+            joblib.delayed(timed)(
+                load_or_fit_model, question, X, y, model_dir, sample_weight
+            )
+            for question, (X, y, sample_weight) in zip(questions, training)
+        )
+    fitted = joblib.Parallel(n_jobs=n_jobs)(jobs)
+
+    models_for_questions = {}
 
+    for question, (m, timing) in zip(questions, fitted):
+        if report is not None:
+            report.append({"stage": f"train: {question}", **timing})
         print("Most import coefficients for question:", question)
-        print(list(zip(X_demographics.columns, m.coef_[0])))
+        print(list(zip(feature_names(preprocessor), m.coef_[0])))
         print()
         models_for_questions[question] = m
 
     return questions, models_for_questions
 
 
-def get_census_data():
-    url = "https://api.census.gov/data/2021/acs/acs1/pums?tabulate=weight(PWGTP)&col+SCHL_RC1&col+HINCP_RC1&col+AGEP_RC1&col+SEX&row+ucgid&ucgid=0300000US1,0300000US2,0300000US3,0300000US4,0300000US5,0300000US6,0300000US7,0300000US8,0300000US9&recode+SCHL_RC1=%7B%22b%22:%22SCHL%22,%22d%22:%5B%5B%220%22,%2201%22,%2202%22,%2203%22,%2204%22,%2205%22,%2206%22,%2207%22,%2208%22,%2209%22,%2210%22,%2211%22,%2212%22,%2213%22,%2214%22,%2215%22%5D,%5B%2216%22,%2217%22%5D,%5B%2218%22,%2219%22,%2220%22%5D,%5B%2221%22%5D,%5B%2222%22,%2223%22,%2224%22%5D%5D%7D&recode+HINCP_RC1=%7B%22b%22:%22HINCP%22,%22d%22:%5B%5B%7B%22mn%22:1,%22mx%22:24999%7D,%220%22%5D,%5B%7B%22mn%22:25000,%22mx%22:49999%7D%5D,%5B%7B%22mn%22:50000,%22mx%22:99999%7D%5D,%5B%7B%22mn%22:100000,%22mx%22:149999%7D%5D,%5B%7B%22mn%22:150000,%22mx%22:9999999%7D%5D%5D%7D&recode+AGEP_RC1=%7B%22b%22:%22AGEP%22,%22d%22:%5B%5B%7B%22mn%22:18,%22mx%22:29%7D%5D,%5B%7B%22mn%22:30,%22mx%22:44%7D%5D,%5B%7B%22mn%22:45,%22mx%22:60%7D%5D,%5B%7B%22mn%22:61,%22mx%22:99%7D%5D%5D%7D"
-    with urllib.request.urlopen(url) as url:
-        data = json.load(url)
-    with open("data.json", "w") as f:
-        json.dump(data, f)
-
-    feature_dictionary = {
-        "SCHL_RC1": {
-            "1": "Less than high school degree",
-            "2": "High school degree",
-            "3": "Some college or Associate degree",
-            "4": "Bachelor degree",
-            "5": "Graduate degree",
-        },
-        "SEX": {"1": "Male", "2": "Female"},
-        "HINCP_RC1": {
-            "1": "$0 - $24,999",
-            "2": "$25,000 - $49,999",
-            "3": "$50,000 - $99,999",
-            "4": "$100,000 - $149,999",
-            "5": "$150,000+",
-        },
-        "AGEP_RC1": {"1": "18-29", "2": "30-44", "3": "45-60", "4": "> 60"},
-    }
+CENSUS_FEATURES = {
+    "SCHL_RC1": {
+        "1": "Less than high school degree",
+        "2": "High school degree",
+        "3": "Some college or Associate degree",
+        "4": "Bachelor degree",
+        "5": "Graduate degree",
+    },
+    "SEX": {"1": "Male", "2": "Female"},
+    "HINCP_RC1": {
+        "1": "$0 - $24,999",
+        "2": "$25,000 - $49,999",
+        "3": "$50,000 - $99,999",
+        "4": "$100,000 - $149,999",
+        "5": "$150,000+",
+    },
+    "AGEP_RC1": {"1": "18-29", "2": "30-44", "3": "45-60", "4": "> 60"},
+}
+
+CENSUS_GEOGRAPHIES = {
+    "0300000US1": "New England",
+    "0300000US2": "Middle Atlantic",
+    "0300000US3": "East North Central",
+    "0300000US4": "West North Central",
+    "0300000US5": "South Atlantic",
+    "0300000US6": "East South Central",
+    "0300000US7": "West South Central",
+    "0300000US8": "Mountain",
+    "0300000US9": "Pacific",
+}
+
+# Survey column -> PUMS variable
+CENSUS_VARIABLES = {
+    "Gender": "SEX",
+    "Age": "AGEP_RC1",
+    "Household Income": "HINCP_RC1",
+    "Education": "SCHL_RC1",
+}
+
+
+# Turn a PUMS tabulate response into one row per (region, cell). data[0] holds
+# the cell headers followed by the row variable, every other row the counts of
+# one region followed by its ucgid. Labels are decoded once per header cell and
+# per region, then broadcast as categorical codes.
+def flatten_census_json(data, geographies=CENSUS_GEOGRAPHIES):
+    header = pd.DataFrame(data[0][:-1])
+    table = np.array(data[1:], dtype=object)
+    counts = table[:, :-1].astype(np.int64)
+    n_regions, n_cells = counts.shape
+
+    cells = pd.DataFrame(
+        {
+            col: header[variable].map(CENSUS_FEATURES[variable])
+            for col, variable in CENSUS_VARIABLES.items()
+        }
+    )
+    regions = pd.DataFrame(
+        {"Location (Census Region)": pd.Series(table[:, -1]).map(geographies)}
+    )
+    for frame in (cells, regions):
+        if frame.isna().to_numpy().any():
+            raise ValueError("Unknown codes in the census response")
+    to_categorical(cells)
+    region_levels = CATEGORY_SCHEMA["Location (Census Region)"][0]
+    if set(regions["Location (Census Region)"]) <= set(region_levels):
+        to_categorical(regions)
+    else:
+        # Geographies finer than census regions (states, PUMAs) keep their own
+        # levels
+        regions = regions.astype("category")
+
+    census_df = pd.DataFrame(
+        {
+            col: pd.Categorical.from_codes(
+                np.tile(cells[col].cat.codes, n_regions), dtype=cells[col].dtype
+            )
+            for col in cells.columns
+        }
+    )
+    location = regions["Location (Census Region)"]
+    census_df["Location (Census Region)"] = pd.Categorical.from_codes(
+        np.repeat(location.cat.codes, n_cells), dtype=location.dtype
+    )
+    census_df["Count"] = counts.ravel()
+    return census_df
 
-    geography_dict = {
-        "0300000US1": "New England",
-        "0300000US2": "Middle Atlantic",
-        "0300000US3": "East North Central",
-        "0300000US4": "West North Central",
-        "0300000US5": "South Atlantic",
-        "0300000US6": "East South Central",
-        "0300000US7": "West South Central",
-        "0300000US8": "Mountain",
-        "0300000US9": "Pacific",
-    }
 
-    for idx, datapoint in enumerate(data[0][:-1]):
-        data[0][idx]["SCHL_RC1"] = feature_dictionary["SCHL_RC1"][datapoint["SCHL_RC1"]]
-        data[0][idx]["SEX"] = feature_dictionary["SEX"][datapoint["SEX"]]
-        data[0][idx]["HINCP_RC1"] = feature_dictionary["HINCP_RC1"][
-            datapoint["HINCP_RC1"]
+def get_census_data(url=CENSUS_URL, **cache_options):
+    data = json.loads(fetch_cached(url, validate=check_json_array, **cache_options))
+    census_df = flatten_census_json(data)
+
+    print("The census contains data for", census_df.Count.sum(), "people")
+
+    return census_df
+
+
+def _bootstrap_replicate(replicate, seed, X, Y, X_cells, weights, base_models):
+    rng = np.random.default_rng([seed, replicate])
+    n_rows = X.shape[0]
+    sample_weight = np.bincount(rng.integers(0, n_rows, n_rows), minlength=n_rows)
+
+    estimates = []
+    for idx, base_model in enumerate(base_models):
+        m = copy.deepcopy(base_model).set_params(warm_start=True)
+        m.fit(X, Y[:, idx], sample_weight=sample_weight)
+        estimates.append(weights @ m.predict_proba(X_cells))
+    return estimates
+
+
+# Bootstrap intervals for the post-stratified estimates. Each replicate
+# resamples the respondents (as bootstrap counts passed as sample_weight, so no
+# resampled copy of the features is built), refits every question's model
+# warm-started from the full-data fit, and re-weights the census cells.
+# Replicates run over n_jobs workers that share the encoded arrays read-only
+# through memory-mapped files. Returns, per question, a frame indexed by answer
+# with the point estimate and the (1 - alpha) percentile interval.
+def bootstrap_poststratify(
+    df,
+    questions,
+    preprocessor,
+    models,
+    census_df,
+    n_boot=200,
+    n_jobs=1,
+    seed=0,
+    alpha=0.05,
+):
+    df_plain = df.dropna()
+    X = _as_matrix(transform_demographics(preprocessor, df_plain))
+    Y = np.column_stack(
+        [
+            pd.Categorical(df_plain[q], categories=models[q].classes_).codes
+            for q in questions
         ]
-        data[0][idx]["AGEP_RC1"] = feature_dictionary["AGEP_RC1"][datapoint["AGEP_RC1"]]
-
-    with open("data.json", "w") as f:
-        json.dump(data, f)
-
-    census_dict = {
-        "Gender": [],
-        "Age": [],
-        "Household Income": [],
-        "Education": [],
-        "Location (Census Region)": [],
-        "Count": [],
-    }
+    ).astype(np.int64)
+    cells = census_cells(census_df)
+    weights = (cells.Count / cells.Count.sum()).to_numpy()
+    X_cells = _as_matrix(transform_demographics(preprocessor, cells))
+
+    # Y holds positions in each model's classes_, so the full-data models can
+    # warm-start fits on the codes and their probabilities stay aligned
+    base_models = [models[q] for q in questions]
+    replicates = joblib.Parallel(n_jobs=n_jobs, max_nbytes="1M", mmap_mode="r")(
+        joblib.delayed(_bootstrap_replicate)(
+            replicate, seed, X, Y, X_cells, weights, base_models
+        )
+        for replicate in range(n_boot)
+    )
+
+    point_estimates = poststratify(models, questions, preprocessor, census_df)
+    intervals = {}
+    for idx, question in enumerate(questions):
+        samples = np.array([replicate[idx] for replicate in replicates])
+        intervals[question] = pd.DataFrame(
+            {
+                "estimate": point_estimates[question],
+                "lower": np.quantile(samples, alpha / 2, axis=0),
+                "upper": np.quantile(samples, 1 - alpha / 2, axis=0),
+            },
+            index=models[question].classes_,
+        )
+    return intervals
+
+
+def census_url(year=2021, geographies=CENSUS_GEOGRAPHIES):
+    return CENSUS_URL_TEMPLATE.format(year=year, ucgids=",".join(geographies))
+
+
+# Census API responses are JSON arrays of rows (the header first); anything
+# else raises a ValueError
+def check_json_array(payload):
+    if not isinstance(json.loads(payload), list):
+        raise ValueError("Expected a JSON array")
+
+
+def _fetch_json_rows(url, cache_options):
+    return json.loads(fetch_cached(url, validate=check_json_array, **cache_options))
+
+
+# Server errors, rate limiting and network failures are worth retrying; a
+# missing cache entry in offline mode or a malformed response is not
+def _is_retryable(error):
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code == 429 or error.code >= 500
+    return isinstance(error, (urllib.error.URLError, ConnectionError, TimeoutError))
+
+
+async def _fetch_census_rows(url, semaphore, retries, backoff, cache_options):
+    loop = asyncio.get_running_loop()
+    async with semaphore:
+        for attempt in range(retries + 1):
+            try:
+                return await loop.run_in_executor(
+                    None, _fetch_json_rows, url, cache_options
+                )
+            except Exception as error:
+                if attempt == retries or not _is_retryable(error):
+                    raise
+                await asyncio.sleep(backoff * 2**attempt)
+
+
+# Fetch several PUMS tabulations concurrently, at most max_concurrency at a
+# time, retrying failed requests with exponential backoff. Each query is a dict
+# with a "year" and "geographies" (ucgid -> label, default the census regions),
+# and optionally the "url" to fetch instead of the API URL built from them.
+# Responses go through the download cache (see cached_file and its
+# cache_options, e.g. offline=True), each distinct URL once. Returns one frame
+# with a Year column; Location holds the geography labels.
+async def fetch_census_tabulations(
+    queries, max_concurrency=4, retries=3, backoff=1.0, **cache_options
+):
+    semaphore = asyncio.Semaphore(max_concurrency)
+    cache_options.setdefault("timeout", 60)
+    urls = [
+        query.get("url")
+        or census_url(
+            query.get("year", 2021), query.get("geographies", CENSUS_GEOGRAPHIES)
+        )
+        for query in queries
+    ]
+    distinct_urls = list(dict.fromkeys(urls))
+    responses = await asyncio.gather(
+        *(
+            _fetch_census_rows(url, semaphore, retries, backoff, cache_options)
+            for url in distinct_urls
+        )
+    )
+    rows = dict(zip(distinct_urls, responses))
 
-    for idx_loc, row in enumerate(data[1:]):
-        for idx_other, count in enumerate(row[:-1]):
-            feature_dict = data[0][idx_other]
-            census_dict["Gender"].append(feature_dict["SEX"])
-            census_dict["Age"].append(feature_dict["AGEP_RC1"])
-            census_dict["Household Income"].append(feature_dict["HINCP_RC1"])
-            census_dict["Education"].append(feature_dict["SCHL_RC1"])
-            census_dict["Location (Census Region)"].append(
-                geography_dict[data[idx_loc + 1][-1]]
+    frames = []
+    for query, url in zip(queries, urls):
+        census_df = flatten_census_json(
+            rows[url], query.get("geographies", CENSUS_GEOGRAPHIES)
+        )
+        census_df["Year"] = query.get("year", 2021)
+        frames.append(census_df)
+    census_df = pd.concat(frames, ignore_index=True)
+    if not isinstance(census_df["Location (Census Region)"].dtype, pd.CategoricalDtype):
+        census_df["Location (Census Region)"] = census_df[
+            "Location (Census Region)"
+        ].astype("category")
+    return census_df
+
+
+def get_census_tabulations(queries, **options):
+    return asyncio.run(fetch_census_tabulations(queries, **options))
+
+
+# Per-respondent raking (iterative proportional fitting) weights that match the
+# weighted survey margins of each column in margins to the census margins.
+# Respondents missing any of those columns get weight 0. Census levels nobody in
+# the survey has cannot be matched and are left out of the targets. Weights are
+# normalized to mean 1 over the raked respondents.
+def rake_weights(df, census_df, margins=DEMOGRAPHICS, tol=1e-6, max_iter=100):
+    complete = np.ones(len(df), dtype=bool)
+    codes, targets = [], []
+    for col in margins:
+        totals = census_df.groupby([col])["Count"].sum()
+        col_codes = pd.Categorical(df[col], categories=list(totals.index)).codes
+        complete &= col_codes >= 0
+        codes.append(col_codes)
+        targets.append(totals.to_numpy(dtype=float))
+    codes = [col_codes[complete].astype(np.int64) for col_codes in codes]
+
+    for idx, col in enumerate(margins):
+        present = np.bincount(codes[idx], minlength=len(targets[idx])) > 0
+        if not present.all():
+            print(f"Raking: {(~present).sum()} census levels of {col} not in survey")
+        targets[idx] = np.where(present, targets[idx], 0) / targets[idx][present].sum()
+
+    w = np.ones(len(codes[0]))
+    for _ in range(max_iter):
+        for col_codes, target in zip(codes, targets):
+            margin = np.bincount(col_codes, weights=w, minlength=len(target))
+            factor = np.divide(
+                target * w.sum(), margin, out=np.ones_like(target), where=margin > 0
             )
-            census_dict["Count"].append(count)
+            w *= factor[col_codes]
+        error = max(
+            np.abs(
+                np.bincount(col_codes, weights=w, minlength=len(target)) / w.sum()
+                - target
+            ).max()
+            for col_codes, target in zip(codes, targets)
+        )
+        if error < tol:
+            break
+    else:
+        print(f"Raking did not converge: max margin error {error:.2g}")
 
-    census_df = pd.DataFrame.from_dict(census_dict)
+    weights = np.zeros(len(df))
+    weights[complete] = w / w.mean()
+    return pd.Series(weights, index=df.index)
 
-    print("The census contains data for", census_df.Count.sum(), "people")
 
-    return census_df
+# Weighted answer distribution of every question (missing answers excluded),
+# one np.bincount per question over its codes
+def raked_estimates(df, weights, questions):
+    weights = np.asarray(weights, dtype=float)
+    estimates = {}
+    for question in questions:
+        answers = pd.Categorical(df[question])
+        answered = answers.codes >= 0
+        totals = np.bincount(
+            answers.codes[answered],
+            weights=weights[answered],
+            minlength=len(answers.categories),
+        )
+        estimates[question] = pd.Series(
+            totals / totals.sum(), index=list(answers.categories)
+        )
+    return estimates
+
+
+# Census population per unique demographic cell
+def census_cells(census_df):
+    return (
+        census_df.groupby(DEMOGRAPHICS, observed=True, sort=False)["Count"]
+        .sum()
+        .reset_index()
+    )
+
+
+# Stack the coefficients of every question's model into one block matrix, so
+# that all questions are scored with a single matrix product. Column block i
+# holds the classes of questions[i]; a binary model's single decision function
+# z is stacked as [-z, z], which is how predict_proba turns it into a
+# two-class softmax.
+def stack_models(models, questions):
+    coefs, intercepts, classes = [], [], []
+    for question in questions:
+        m = models[question]
+        coef, intercept = m.coef_, m.intercept_
+        if len(m.classes_) == 2 and coef.shape[0] == 1:
+            coef = np.vstack([-coef, coef])
+            intercept = np.concatenate([-intercept, intercept])
+        coefs.append(coef)
+        intercepts.append(intercept)
+        classes.append(m.classes_)
+    return {
+        "questions": list(questions),
+        "classes": classes,
+        "coef": np.vstack(coefs).T,
+        "intercept": np.concatenate(intercepts),
+        "offsets": np.cumsum([0] + [len(c) for c in classes]),
+    }
+
+
+# Class probabilities of every stacked question for the encoded rows X, as one
+# (rows, classes) array: a softmax within each column block, using
+# np.maximum.reduceat / np.add.reduceat over the block offsets
+def predict_proba_stacked(stacked, X):
+    scores = np.asarray(_as_matrix(X) @ stacked["coef"]) + stacked["intercept"]
+    starts = stacked["offsets"][:-1]
+    widths = np.diff(stacked["offsets"])
+    scores -= np.repeat(np.maximum.reduceat(scores, starts, axis=1), widths, axis=1)
+    np.exp(scores, out=scores)
+    scores /= np.repeat(np.add.reduceat(scores, starts, axis=1), widths, axis=1)
+    return scores
+
+
+# Census-weighted answer probabilities for every question, in the order of each
+# model's classes_. Each unique demographic cell is scored once for all
+# questions (see predict_proba_stacked) and weighted with one matrix product.
+def poststratify(models, questions, preprocessor, census_df, report=None):
+    cells = census_cells(census_df)
+    weights = (cells.Count / cells.Count.sum()).to_numpy()
+    X_cells = transform_demographics(preprocessor, cells)
+
+    stacked = stack_models(models, questions)
+    predictions, timing = timed(predict_proba_stacked, stacked, X_cells)
+    if report is not None:
+        report.append({"stage": "score: all questions", **timing})
+    weighted = weights @ predictions
+
+    offsets = stacked["offsets"]
+    return {
+        question: weighted[offsets[idx] : offsets[idx + 1]]
+        for idx, question in enumerate(stacked["questions"])
+    }
+
+
+# Post-stratified estimates as a tidy frame with one row per (Question, Answer)
+# and its Probability, answers in the order of each model's classes_
+def poststratified_table(weighted_by_question, models):
+    return pd.DataFrame(
+        {
+            "Question": np.repeat(
+                list(weighted_by_question),
+                [len(models[q].classes_) for q in weighted_by_question],
+            ),
+            "Answer": np.concatenate(
+                [models[q].classes_ for q in weighted_by_question]
+            ),
+            "Probability": np.concatenate(list(weighted_by_question.values())),
+        }
+    )
 
 
 def create_pie_plots(df, col):
+    import matplotlib.pyplot as plt
+
     col_df = df.groupby([col])["Count"].sum()
     plt.figure(figsize=(14, 8))
     plt.pie(col_df.to_numpy(), labels=list(col_df.index), autopct="%1.1f%%")
     plt.title(col)
 
-    plt.savefig(f"pie_{col.replace(' ', '')}.png")
+    plt.savefig(chart_file("pie", col))
     plt.close()
     print()
 
 
 def plot_pie_in_pie(survey_dict, census_dataframe, feature):
+    import matplotlib.colors as mcolors
+    import matplotlib.pyplot as plt
+
     fig, ax = plt.subplots(figsize=(12, 12))
     size = 0.35
     outer = census_dataframe.groupby([feature])["Count"].sum()
@@ -499,11 +1577,13 @@ def plot_pie_in_pie(survey_dict, census_dataframe, feature):
         title=f"\n{feature}\n Outer chart: Census Data\n Inner chart: Survey Data",
     )
 
-    plt.savefig(f"pie_in_pie_{feature.replace(' ','')}.png")
+    plt.savefig(chart_file("pie_in_pie", feature))
     plt.close()
 
 
 def multi_barplot(survey_dict, census_dataframe, feature):
+    import matplotlib.pyplot as plt
+
     census = (
         census_dataframe.groupby([feature])["Count"].sum()
         / census_dataframe.Count.sum()
@@ -533,11 +1613,13 @@ def multi_barplot(survey_dict, census_dataframe, feature):
     plt.title(feature)
     ax.legend()
 
-    plt.savefig(f"multi_barplot_{feature.replace(' ', '')}")
+    plt.savefig(chart_file("multi_barplot", feature))
     plt.close()
 
 
 def barh(results, category_names, title):
+    import matplotlib.pyplot as plt
+
     category_names = replace_every_nth_space(category_names, 3)
     labels = list(results.keys())
     data = np.array(list(results.values())) * 100
@@ -571,63 +1653,534 @@ def barh(results, category_names, title):
             loc="lower left",
             fontsize="small",
         )
-    plt.savefig(f"barh_{title.replace(' ', '')}")
+    plt.savefig(chart_file("barh", title))
     plt.close()
     return fig, ax
 
 
+# Call func(*args) and return its result with its wall and CPU time
+def timed(func, *args):
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = func(*args)
+    return result, {
+        "wall_s": time.perf_counter() - wall,
+        "cpu_s": time.process_time() - cpu,
+    }
 
-if __name__ == "__main__":
-    """ Steps 1 and 2 """
-    df = assemble_original_and_extra_survey()
-    demographic_groups, answers = format_survey_data(df)
 
-    analyze_assembled_survey(df, demographic_groups, answers)
+_stage_peaks = []
+_stage_profiling = []
+
+
+# Record wall time, CPU time and peak RSS of the enclosed block as one entry of
+# report, and with trace_memory its peak traced Python memory. Stages can be
+# nested; a stage's peak includes the peaks of the stages inside it, and tracing
+# stops when the stage that started it ends. With a profile_dir, the outermost
+# stage being profiled is dumped to <profile_dir>/<name>.prof.
+@contextlib.contextmanager
+def stage(name, report, profile_dir=None, trace_memory=TRACE_MEMORY):
+    entry = {"stage": name}
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if trace_memory:
+        if started_tracing:
+            tracemalloc.start()
+        if _stage_peaks:
+            peak = tracemalloc.get_traced_memory()[1]
+            _stage_peaks[-1] = max(_stage_peaks[-1], peak)
+        tracemalloc.reset_peak()
+        _stage_peaks.append(0)
+
+    profiler = None
+    if profile_dir is not None and not _stage_profiling:
+        profiler = cProfile.Profile()
+        _stage_profiling.append(profiler)
+        profiler.enable()
+
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield entry
+    finally:
+        entry["wall_s"] = time.perf_counter() - wall
+        entry["cpu_s"] = time.process_time() - cpu
+
+        if profiler is not None:
+            profiler.disable()
+            _stage_profiling.pop()
+            os.makedirs(profile_dir, exist_ok=True)
+            file_name = "".join(c if c.isalnum() else "_" for c in name)
+            profiler.dump_stats(os.path.join(profile_dir, f"{file_name}.prof"))
+
+        if trace_memory:
+            peak = max(_stage_peaks.pop(), tracemalloc.get_traced_memory()[1])
+            if _stage_peaks:
+                _stage_peaks[-1] = max(_stage_peaks[-1], peak)
+            entry["peak_traced_mb"] = peak / 2**20
+            if started_tracing:
+                tracemalloc.stop()
+        if resource is not None:
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            scale = 2**20 if os.uname().sysname == "Darwin" else 2**10
+            entry["max_rss_mb"] = max_rss / scale
+        report.append(entry)
+
+
+def write_run_report(report, path=RUN_REPORT_PATH):
+    if path.endswith(".csv"):
+        fields = []
+        for entry in report:
+            fields += [key for key in entry if key not in fields]
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(report)
+    else:
+        with open(path, "w") as f:
+            json.dump(report, f, indent=1)
+
+
+# Post-stratified estimates held in memory for repeated queries. Every census
+# cell is scored once for all questions at start-up; an estimate for a subgroup
+# is then a weighted sum over the matching cells, and the most recent
+# cache_size subgroups are kept in an LRU cache.
+class EstimateService:
+    def __init__(self, models, questions, preprocessor, census_df, cache_size=4096):
+        self.cells = census_cells(census_df)
+        self.counts = self.cells.Count.to_numpy(dtype=np.float64)
+        self.stacked = stack_models(models, questions)
+        self.predictions = predict_proba_stacked(
+            self.stacked, transform_demographics(preprocessor, self.cells)
+        )
+        offsets = self.stacked["offsets"]
+        self.blocks = {
+            question: slice(offsets[idx], offsets[idx + 1])
+            for idx, question in enumerate(self.stacked["questions"])
+        }
+        self.cell_levels = {
+            col: self.cells[col].astype(str).to_numpy() for col in DEMOGRAPHICS
+        }
+        self.levels = {col: set(levels) for col, levels in self.cell_levels.items()}
+        self._subgroup_distribution = functools.lru_cache(maxsize=cache_size)(
+            self._subgroup_distribution
+        )
+
+    # subgroup: {demographic column: [levels]}, as a hashable, order-free key
+    def subgroup_key(self, subgroup):
+        key = []
+        for col, levels in sorted(subgroup.items()):
+            if col not in self.levels:
+                raise ValueError(f"Unknown demographic column: {col}")
+            unknown = set(levels) - self.levels[col]
+            if unknown:
+                raise ValueError(f"Unknown levels of {col}: {sorted(unknown)}")
+            key.append((col, tuple(sorted(levels))))
+        return tuple(key)
+
+    # Census population and weighted answer probabilities (of every question, in
+    # stacked column order) of the cells in the subgroup
+    def _subgroup_distribution(self, key):
+        mask = np.ones(len(self.cells), dtype=bool)
+        for col, levels in key:
+            mask &= np.isin(self.cell_levels[col], levels)
+        weights = self.counts[mask]
+        population = weights.sum()
+        if population == 0:
+            return 0.0, None
+        return population, weights @ self.predictions[mask] / population
+
+    def estimate(self, question, subgroup=None):
+        if question not in self.blocks:
+            raise ValueError(f"Unknown question: {question}")
+        key = self.subgroup_key(subgroup or {})
+        population, distribution = self._subgroup_distribution(key)
+        classes = self.stacked["classes"][self.stacked["questions"].index(question)]
+        if distribution is None:
+            probabilities = [None] * len(classes)
+        else:
+            probabilities = distribution[self.blocks[question]].tolist()
+        return {
+            "question": question,
+            "subgroup": {col: list(levels) for col, levels in key},
+            "population": float(population),
+            "answers": dict(zip(map(str, classes), probabilities)),
+        }
+
+    def questions(self):
+        return {
+            question: [str(c) for c in classes]
+            for question, classes in zip(
+                self.stacked["questions"], self.stacked["classes"]
+            )
+        }
+
+
+# GET /questions lists the questions and their answers. GET /estimate?question=Q
+# returns the census-weighted answer distribution of Q, restricted to a subgroup
+# by any other parameters, e.g. &Gender=Female&Age=18-29&Age=30-44 (repeated
+# parameters select several levels).
+class EstimateRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        service = self.server.service
+        if url.path == "/questions":
+            return self._send_json(200, service.questions())
+        if url.path != "/estimate":
+            return self._send_json(404, {"error": f"Unknown path: {url.path}"})
+        if len(params.get("question", [])) != 1:
+            return self._send_json(400, {"error": "Expected one question"})
+        question = params.pop("question")[0]
+        try:
+            result = service.estimate(question, params)
+        except ValueError as e:
+            return self._send_json(400, {"error": str(e)})
+        self._send_json(200, result)
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+""" Steps 1 and 2 """
+
+
+def load_survey(report):
+    with stage("assemble survey", report, PROFILE_DIR):
+        if SURVEY_PARTITIONS:
+            # The same files the counts and charts are aggregated from
+            frames = [_load_partition(path) for path in survey_partitions()]
+            return to_categorical(pd.concat(frames, ignore_index=True))
+        if FRAME_DIR:
+            return load_or_build_frame(
+                os.path.join(FRAME_DIR, "survey.feather"),
+                assemble_original_and_extra_survey,
+                survey_sources(),
+            )
+        return assemble_original_and_extra_survey()
+
+
+# Counts of the survey partitions (see survey_partitions), or of its chunks
+def count_survey(partitions, report, counts_path=None, n_jobs=N_JOBS):
+    with stage("format survey", report, PROFILE_DIR):
+        store = partitioned_counts(partitions, n_jobs=n_jobs)
+        if counts_path:
+            save_counts(store, counts_path)
+        return format_survey_counts(store)
+
+
+""" Section 3 """
+
+
+# Fit the preprocessor (or, without refit, load the saved one when it has the
+# configured sparsity) and fit or load the models from the model store
+def train(df, answers, report, n_jobs=N_JOBS, refit=True):
+    with stage("train", report, PROFILE_DIR):
+        preprocessor = None
+        if not refit and os.path.exists(PREPROCESSOR_PATH):
+            preprocessor = load_preprocessor()
+            if (preprocessor.sparse_threshold > 0) != SPARSE_FEATURES:
+                preprocessor = None
+        if preprocessor is None:
+            preprocessor = fit_preprocessor(df.dropna(), SPARSE_FEATURES)
+            save_preprocessor(preprocessor)
+        questions, models = make_models(
+            df,
+            answers.keys(),
+            preprocessor,
+            n_jobs,
+            MODEL_DIR,
+            report,
+            COLLAPSE_TRAINING,
+        )
+    return preprocessor, questions, models
 
-    """ Section 3 """
 
-    questions, models = make_models(df)
+""" Section 4 """
 
-    """ Section 4 """
 
-    census_df = get_census_data()
-    create_pie_plots(census_df, "Household Income")
-    plot_pie_in_pie(demographic_groups, census_df, "Location (Census Region)")
-    multi_barplot(demographic_groups, census_df, "Household Income")
+def load_census(report):
+    with stage("census data", report, PROFILE_DIR):
+        if FRAME_DIR:
+            return load_or_build_frame(
+                os.path.join(FRAME_DIR, "census.feather"),
+                get_census_data,
+                [cached_file(CENSUS_URL, validate=check_json_array)],
+            )
+        return get_census_data()
 
-    """ Section 5 """
 
-    df_plain = df.dropna()
-    _, census_preprocessed = preprocess_data(df_plain, census_df)
+""" Section 5 """
+
+
+# Print the post-stratified estimates next to the raw survey shares and return
+# the barh chart specs and the results of the last question
+def report_poststratified(
+    answers, questions, models, preprocessor, census_df, report
+):
+    with stage("post-stratification", report, PROFILE_DIR):
+        weighted_by_question = poststratify(
+            models, questions, preprocessor, census_df, report
+        )
+        estimates = poststratified_table(weighted_by_question, models).set_index(
+            ["Question", "Answer"]
+        )["Probability"]
+
+        barh_specs = []
+        results = None
+        for question in questions:
+            print(question)
+            answer_options = answers[question][0]
+            answer_counts = answers[question][1]
+            print(answers[question][0])
+
+            if (
+                question
+                != "In your opinion, which sentence is more gramatically correct?"
+            ):
+                answer_options = answers[question][0][:-1]
+                answer_counts = answers[question][1][:-1]
+
+            weighted_predictions = (
+                estimates[question].reindex(answer_options).to_numpy()
+            )
+            survey_probs = answer_counts / sum(answer_counts)
+            results = {"Census": weighted_predictions, "Post-Strat": survey_probs}
+            print("survey probs: ", survey_probs)
+            print("Probabilities: ", weighted_predictions)
+            print()
+
+            barh_specs.append(
+                (
+                    chart_file("barh", question),
+                    0.8,
+                    barh,
+                    (results, answer_options, question),
+                )
+            )
+    return barh_specs, results
 
-    counts = census_df.Count / census_df.Count.sum()
 
-    census_df.Count.sum()
+def report_raked(df, census_df, questions, report):
+    with stage("raking", report, PROFILE_DIR):
+        raked = raked_estimates(df, rake_weights(df, census_df), questions)
+    for question in questions:
+        print(question)
+        print("Raked: ", raked[question].to_dict())
+        print()
 
 
+def report_bootstrap(
+    df, questions, preprocessor, models, census_df, report, n_boot, n_jobs
+):
+    with stage("bootstrap", report, PROFILE_DIR):
+        intervals = bootstrap_poststratify(
+            df, questions, preprocessor, models, census_df, n_boot, n_jobs
+        )
     for question in questions:
         print(question)
-        answer_options = answers[question][0]
-        answer_counts = answers[question][1]
-        print(answers[question][0])
-        predictions = models[question].predict_proba(census_preprocessed)
-
-        weighted_predictions = predictions.transpose() @ counts
-        if question != "In your opinion, which sentence is more gramatically correct?":
-            answer_options = answers[question][0][:-1]
-            answer_counts = answers[question][1][:-1]
-
-        weighted_predictions = [
-            weighted_predictions[np.where(models[question].classes_ == option)][0]
-            for option in answer_options
-        ]
-        survey_probs = answer_counts / sum(answer_counts)
-        results = {"Census": weighted_predictions, "Post-Strat": survey_probs}
-        print("survey probs: ", survey_probs)
-        print("Probabilities: ", weighted_predictions)
+        print(intervals[question])
         print()
 
-        barh(results, answer_options, question)
 
+def serve(df, answers, report, host, port, cache_size, n_jobs=N_JOBS):
+    preprocessor, questions, models = train(df, answers, report, n_jobs, False)
+    census_df = load_census(report)
+    with stage("score census cells", report, PROFILE_DIR):
+        service = EstimateService(
+            models, questions, preprocessor, census_df, cache_size
+        )
+    write_run_report(report)
+
+    server = http.server.ThreadingHTTPServer((host, port), EstimateRequestHandler)
+    server.service = service
+    print(f"Serving estimates on http://{host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# Subcommands, each running the stages up to its own:
+#   fetch         download the survey and census data into the cache
+#   counts        answer and demographic counts (no scikit-learn or matplotlib)
+#   train         fit the preprocessor and the per-question models
+#   poststratify  post-stratified, raked (and bootstrap) estimates, no charts
+#   plots         every chart, with the post-stratified estimates
+#   all           everything (the default)
+#   serve         answer estimate queries over HTTP (see EstimateRequestHandler)
+COMMANDS = ["fetch", "counts", "train", "poststratify", "plots", "all", "serve"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Comma survey analysis with census post-stratification"
+    )
+    parser.add_argument(
+        "--n-jobs",
+        type=int,
+        default=N_JOBS,
+        help="worker processes for training and charts (-1 for all cores)",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    for command in COMMANDS:
+        subparser = subparsers.add_parser(command)
+        if command == "fetch":
+            subparser.add_argument(
+                "--years",
+                nargs="+",
+                type=int,
+                default=[2021],
+                help="ACS years to fetch census tabulations for, concurrently",
+            )
+        if command == "counts":
+            subparser.add_argument(
+                "--save", metavar="PATH", help="write the counts store as JSON"
+            )
+            subparser.add_argument(
+                "--append",
+                nargs="+",
+                metavar="WAVE",
+                help="add the responses of these CSV files to the counts store "
+                "at --save, without re-reading the survey",
+            )
+            subparser.add_argument(
+                "--stream",
+                action="store_true",
+                help="count the survey files chunk by chunk, without assembling",
+            )
+        if command in ("poststratify", "all"):
+            subparser.add_argument(
+                "--bootstrap",
+                type=int,
+                default=N_BOOT,
+                metavar="N",
+                help="bootstrap replicates for interval estimates (0 to skip)",
+            )
+        if command == "serve":
+            subparser.add_argument("--host", default="127.0.0.1")
+            subparser.add_argument("--port", type=int, default=8000)
+            subparser.add_argument(
+                "--cache-size",
+                type=int,
+                default=4096,
+                help="subgroup estimates kept in the LRU cache",
+            )
+    # Options of the subcommands, for the bare invocation (which runs "all")
+    parser.set_defaults(bootstrap=N_BOOT, save=None, stream=False, append=None)
+    args = parser.parse_args(argv)
+    command = args.command or "all"
+    plots = command in ("plots", "all")
+    report = []
+
+    if command == "fetch":
+        with stage("fetch", report, PROFILE_DIR):
+            cached_file(SURVEY_URL)
+            census_df = get_census_tabulations(
+                [{"year": year} for year in args.years]
+            )
+        print(census_df.groupby("Year")["Count"].sum())
+        write_run_report(report)
+        return
+
+    if command == "counts" and args.append:
+        if not args.save or not os.path.exists(args.save):
+            parser.error("--append needs an existing counts store at --save")
+        columns = list(pd.read_csv(cached_file(SURVEY_URL), nrows=0).columns)
+        with stage("format survey", report, PROFILE_DIR):
+            store = update_counts_file(
+                args.save, iter_survey_chunks(args.append, columns=columns)
+            )
+            format_survey_counts(store)
+        write_run_report(report)
+        return
+
+    if command == "counts" and args.stream:
+        count_survey(
+            iter_survey_chunks(survey_sources()), report, args.save, args.n_jobs
+        )
+        write_run_report(report)
+        return
+
+    if command == "counts" and SURVEY_PARTITIONS:
+        count_survey(survey_partitions(), report, args.save, args.n_jobs)
+        write_run_report(report)
+        return
+
+    df = load_survey(report)
+    if command == "serve":
+        _, answers = format_survey_counts(update_counts({}, df), verbose=False)
+        serve(
+            df, answers, report, args.host, args.port, args.cache_size, args.n_jobs
+        )
+        return
+    partitions = survey_partitions(df)
+    demographic_groups, answers = count_survey(
+        partitions, report, args.save, args.n_jobs
+    )
+    if plots:
+        with stage("survey charts", report, PROFILE_DIR):
+            analyze_assembled_survey(
+                partitions, demographic_groups, answers, args.n_jobs, CHART_MANIFEST
+            )
+    if command == "counts":
+        write_run_report(report)
+        return
+
+    preprocessor, questions, models = train(
+        df, answers, report, args.n_jobs, command in ("train", "all")
+    )
+    if command == "train":
+        write_run_report(report)
+        return
+
+    census_df = load_census(report)
+    if plots:
+        with stage("census charts", report, PROFILE_DIR):
+            render_charts(
+                census_chart_specs(
+                    demographic_groups, census_df, n_jobs=args.n_jobs
+                ),
+                args.n_jobs,
+                CHART_MANIFEST,
+            )
+
+    barh_specs, results = report_poststratified(
+        answers, questions, models, preprocessor, census_df, report
+    )
+    if command in ("poststratify", "all"):
+        report_raked(df, census_df, questions, report)
+        if args.bootstrap:
+            report_bootstrap(
+                df,
+                questions,
+                preprocessor,
+                models,
+                census_df,
+                report,
+                args.bootstrap,
+                args.n_jobs,
+            )
+    if plots:
+        with stage("post-stratification charts", report, PROFILE_DIR):
+            render_charts(barh_specs, args.n_jobs, CHART_MANIFEST)
 
     print(results)
+
+    write_run_report(report)
+
+
+if __name__ == "__main__":
+    # Run the imported module rather than __main__, so that the saved
+    # preprocessor refers to survey_analysis functions and loads anywhere
+    import survey_analysis
+
+    survey_analysis.main()